@@ -0,0 +1,94 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+from models import const
+from models.blocks import Attention, WindowAttention
+
+
+def level_shapes(down_channels, down_sample):
+    # (channels, (d, h, w)) at the output of every down block of the unet
+    spatial = list(const.LATENT_SHAPE_DM[1:])
+    shapes = []
+    for channels, down in zip(down_channels[1:], down_sample):
+        shapes.append((channels, tuple(spatial)))
+        if down:
+            spatial = [size // 2 for size in spatial]
+    return shapes
+
+
+def attention_flops(kind, channels, spatial, window_size):
+    # Multiply-adds x 2 of the q/k/v/out projections plus QK^T and AV
+    tokens = spatial[0] * spatial[1] * spatial[2]
+    projections = 2 * 4 * tokens * channels * channels
+    if kind == 'global':
+        keys = tokens
+    else:
+        keys = 1
+        for size, window in zip(spatial, window_size):
+            keys *= min(size, window)
+    return projections + 2 * 2 * tokens * keys * channels
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@torch.no_grad()
+def run_case(kind, channels, spatial, num_heads, window_size, batch_size, repeats, queue):
+    # Runs in a fresh process so the peak RSS belongs to this case alone
+    torch.manual_seed(0)
+    if kind == 'global':
+        attention = Attention(channels, num_heads).eval()
+    else:
+        attention = WindowAttention(channels, num_heads, window_size=window_size,
+                                    shift_size=tuple(w // 2 for w in window_size)).eval()
+    x = torch.randn(batch_size, spatial[0] * spatial[1] * spatial[2], channels)
+    baseline = peak_rss_mb()
+    attention.self_attend(x, spatial)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        attention.self_attend(x, spatial)
+    elapsed = (time.perf_counter() - start) / repeats
+    queue.put({'time_s': elapsed, 'peak_rss_mb': peak_rss_mb(), 'rss_increase_mb': peak_rss_mb() - baseline})
+
+
+def measure(*case):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=case + (queue,))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'error': f'exit code {process.exitcode}'}
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Global vs windowed self-attention at every unet resolution')
+    parser.add_argument('--down_channels', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--down_sample', type=int, nargs='+', default=[1, 1, 1])
+    parser.add_argument('--num_heads', type=int, default=4)
+    parser.add_argument('--window_size', type=int, nargs=3, default=[4, 4, 4])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max_global_tokens', type=int, default=None,
+                        help='skip global attention above this many voxels')
+    args = parser.parse_args()
+
+    window_size = tuple(args.window_size)
+    for channels, spatial in level_shapes(args.down_channels, args.down_sample):
+        tokens = spatial[0] * spatial[1] * spatial[2]
+        for kind in ('global', 'window'):
+            if kind == 'global' and args.max_global_tokens is not None and tokens > args.max_global_tokens:
+                print(f'{kind:6s} C={channels:4d} {spatial} skipped ({tokens} voxels)')
+                continue
+            result = measure(kind, channels, spatial, args.num_heads, window_size, args.batch_size, args.repeats)
+            gflops = attention_flops(kind, channels, spatial, window_size) * args.batch_size / 1e9
+            print(f'{kind:6s} C={channels:4d} {spatial} voxels={tokens:6d} GFLOPs={gflops:9.2f} {result}')
+
+
+if __name__ == '__main__':
+    main()
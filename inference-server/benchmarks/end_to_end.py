@@ -0,0 +1,174 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from models import const
+from models.profiler import ModuleProfiler
+from tools import inference
+from worker.model_registry import load_config, build_models
+
+# Stage timings of one job, from config load to the saved NIfTI, with the controlnet / vqvae
+# built from the config with random weights and a random latent as input, so neither the
+# checkpoints nor RabbitMQ / the backend are needed. Every (batch size, threads) case runs in
+# its own process so its peak RSS and thread setting do not leak into the next one.
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def sync():
+    if inference.get_device().type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timed(fn, repeats):
+    # Mean wall time over repeats, after one untimed call
+    out = fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    sync()
+    return out, (time.perf_counter() - start) / repeats
+
+
+@torch.no_grad()
+def run_case(config_path, batch_size, num_threads, num_steps, repeats, profile_dir, queue):
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(0)
+    result = {'batch_size': batch_size, 'num_threads': num_threads, 'num_steps': num_steps}
+
+    start = time.perf_counter()
+    config = load_config(config_path)
+    inference_config = config.setdefault('inference_params', {})
+    # Both need checkpoints on disk, every other inference setting is benchmarked as configured
+    inference_config['quantization'] = {'enabled': False}
+    inference_config['mmap_checkpoints'] = {'enabled': False}
+    models = build_models(config, inference.get_device(), load_weights=False)
+    sync()
+    result['load_s'] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The worker's inputs are latents saved with np.save
+        input_path = os.path.join(tmp_dir, 'input.npy')
+        np.save(input_path, np.random.rand(*const.LATENT_SHAPE_DM).astype(np.float32))
+        (context, controlnet_condition), result['preprocess_s'] = timed(
+            lambda: inference.preprocess(input_path, 1, 0.5, 0.7, 0.8), repeats)
+        context = context.expand(batch_size, -1).contiguous()
+        controlnet_condition = controlnet_condition.expand(batch_size, -1, -1, -1, -1).contiguous()
+
+        xt = torch.randn((batch_size, *const.LATENT_SHAPE_DM), device=inference.get_device())
+        t = torch.full((batch_size,), 500, dtype=torch.long, device=inference.get_device())
+        _, result['step_s'] = timed(lambda: models.denoiser(xt, t, context, controlnet_condition), repeats)
+
+        sampler = inference.build_sampler(models, 'ddim', num_steps, seed=0)
+        start = time.perf_counter()
+        xt = inference.sample_latents(models, context, controlnet_condition, sampler)
+        sync()
+        result['sample_s'] = time.perf_counter() - start
+        result['steps_per_s'] = num_steps / result['sample_s']
+        result['sample_steps_per_s'] = batch_size * num_steps / result['sample_s']
+
+        if profile_dir is not None:
+            # Separate, untimed run: the hooks slow every module call down
+            profiler = ModuleProfiler({'controlnet': models.controlnet, 'vqvae': models.vqvae})
+            with profiler:
+                inference.sample_latents(models, context, controlnet_condition,
+                                         inference.build_sampler(models, 'ddim', num_steps, seed=0))
+            result['profile'] = profiler.save(profile_dir, f'b{batch_size}_t{num_threads}')
+
+        # The worker decodes and saves one sample at a time
+        ims, result['decode_s'] = timed(lambda: inference.decode_latents(models, xt[:1]), repeats)
+        _, result['save_s'] = timed(lambda: inference.save_result(ims, os.path.join(tmp_dir, 'input.nii')), repeats)
+
+    result['job_s'] = (result['preprocess_s'] + result['sample_s'] / batch_size
+                       + result['decode_s'] + result['save_s'])
+    result['peak_rss_mb'] = peak_rss_mb()
+    queue.put(result)
+
+
+def measure(*case):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=case + (queue,))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'error': f'exit code {process.exitcode}'}
+    return queue.get()
+
+
+def regressions(results, baseline, tolerance):
+    # Cases whose stage times grew (or throughput dropped) by more than tolerance vs the baseline run
+    previous = {(r['batch_size'], r['num_threads']): r for r in baseline['results'] if 'error' not in r}
+    found = []
+    for result in results:
+        old = previous.get((result['batch_size'], result['num_threads']))
+        if old is None or 'error' in result:
+            continue
+        for name in ('load_s', 'preprocess_s', 'step_s', 'sample_s', 'decode_s', 'save_s', 'peak_rss_mb'):
+            if result[name] > old[name] * (1 + tolerance):
+                found.append((result['batch_size'], result['num_threads'], name, old[name], result[name]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage timings of the inference worker with random weights')
+    parser.add_argument('--config', dest='config_path', default='config/adni.yaml', type=str)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--num_threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--num_steps', type=int, default=10, help='DDIM steps of the sampling loop')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='also write a per-module profile of the sampling loop of every case here')
+    parser.add_argument('--output', type=str, default='benchmarks/results/end_to_end.json')
+    parser.add_argument('--baseline', type=str, default=None, help='earlier --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown vs the baseline')
+    args = parser.parse_args()
+
+    results = []
+    for num_threads in args.num_threads:
+        for batch_size in args.batch_sizes:
+            result = measure(args.config_path, batch_size, num_threads, args.num_steps, args.repeats,
+                             args.profile_dir)
+            result.setdefault('batch_size', batch_size)
+            result.setdefault('num_threads', num_threads)
+            results.append(result)
+            print(json.dumps(result))
+
+    report = {
+        'config': args.config_path,
+        'device': str(inference.get_device()),
+        'torch': torch.__version__,
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for batch_size, num_threads, name, old, new in found:
+            print(f'[ERROR] batch {batch_size}, {num_threads} threads: {name} {old:.4g} -> {new:.4g}')
+        if found:
+            sys.exit(1)
+        print(f'No regressions beyond {args.tolerance:.0%} vs {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import copy
+import time
+import torch
+from models import const
+from models.precision import DTYPES, AutocastCall, prepare_mixed_precision
+from scheduler.samplers import get_sampler
+from worker.model_registry import LoadedModels, load_config, build_models
+
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def sample(models, xt, context, hint, num_steps, seed):
+    generator = torch.Generator(device=xt.device).manual_seed(seed)
+    sampler = get_sampler(models.scheduler, 'ddim', num_steps, eta=0., generator=generator)
+    for i, t in enumerate(sampler.timesteps):
+        t_tensor = torch.full((xt.size(0),), int(t), dtype=torch.long, device=xt.device)
+        noise_pred = models.denoiser(xt, t_tensor, context, hint)
+        xt, _ = sampler.step(xt, noise_pred, i)
+    return xt
+
+
+def error(reference, candidate):
+    diff = (reference.float() - candidate.float()).abs()
+    return {'max_abs': diff.max().item(), 'mean_abs': diff.mean().item()}
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy / latency of mixed precision vs fp32 inference')
+    parser.add_argument('--config', dest='config_path', default='config/adni.yaml', type=str)
+    parser.add_argument('--dtype', type=str, default='bfloat16', choices=sorted(DTYPES))
+    parser.add_argument('--no_channels_last', action='store_true')
+    parser.add_argument('--random_weights', action='store_true',
+                        help='skip checkpoint loading (latency only, errors are not representative)')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_steps', type=int, default=10, help='DDIM steps for the end-to-end comparison')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    config = load_config(args.config_path)
+    inference_config = config.setdefault('inference_params', {})
+    # Compare the plain eager models, the mixed precision copy is made here
+    inference_config['quantization'] = {'enabled': False}
+    inference_config['compile'] = {'enabled': False}
+    inference_config['precision'] = {'dtype': 'float32', 'channels_last': False}
+
+    device = torch.device(args.device)
+    dtype = DTYPES[args.dtype]
+    channels_last = not args.no_channels_last
+    reference = build_models(config, device, load_weights=not args.random_weights)
+
+    controlnet = prepare_mixed_precision(copy.deepcopy(reference.controlnet), channels_last)
+    vqvae = prepare_mixed_precision(copy.deepcopy(reference.vqvae), channels_last)
+    mixed = LoadedModels(config, controlnet, vqvae, reference.scheduler, device)
+    mixed.denoiser = AutocastCall(controlnet, device.type, dtype, channels_last)
+    mixed.decoder = AutocastCall(vqvae.decode, device.type, dtype, channels_last)
+
+    ldm_config = config['ldm_params']
+    context_dim = ldm_config['condition_config']['context_condition_config']['context_embed_dim']
+    torch.manual_seed(0)
+    xt = torch.randn((args.batch_size, *const.LATENT_SHAPE_DM), device=device)
+    t = torch.full((args.batch_size,), 500, dtype=torch.long, device=device)
+    context = torch.rand((args.batch_size, context_dim), device=device)
+    hint = torch.randn((args.batch_size, ldm_config['hint_channels'], *const.LATENT_SHAPE_DM[1:]), device=device)
+
+    report = {'dtype': args.dtype, 'channels_last_3d': channels_last}
+    fp32_pred, report['fp32_step_s'] = timed(lambda: reference.denoiser(xt, t, context, hint), args.repeats)
+    mixed_pred, report['mixed_step_s'] = timed(lambda: mixed.denoiser(xt, t, context, hint), args.repeats)
+    report['noise_pred_error'] = error(fp32_pred, mixed_pred)
+
+    fp32_ims, report['fp32_decode_s'] = timed(lambda: reference.decoder(xt), args.repeats)
+    mixed_ims, report['mixed_decode_s'] = timed(lambda: mixed.decoder(xt), args.repeats)
+    report['decode_error'] = error(fp32_ims, mixed_ims)
+
+    # Errors compound over the sampling loop, so also compare the decoded end result
+    fp32_latent = sample(reference, xt, context, hint, args.num_steps, seed=0)
+    mixed_latent = sample(mixed, xt, context, hint, args.num_steps, seed=0)
+    report['latent_error'] = error(fp32_latent, mixed_latent)
+    # Decoded volumes in [0, 1] as served
+    fp32_volume = (torch.clamp(reference.decoder(fp32_latent), -1., 1.) + 1) / 2
+    mixed_volume = (torch.clamp(mixed.decoder(mixed_latent), -1., 1.) + 1) / 2
+    report['volume_error'] = error(fp32_volume, mixed_volume)
+
+    report['step_speedup'] = report['fp32_step_s'] / report['mixed_step_s']
+    report['decode_speedup'] = report['fp32_decode_s'] / report['mixed_decode_s']
+    for name, value in report.items():
+        print(f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+from models.vqvae import VQVAE
+from worker.model_registry import load_config
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cdist_indices(vqvae, x):
+    # The previous search: the codebook copied per batch element and a full (B, N, K) distance tensor
+    x = x.permute(0, 2, 3, 4, 1)
+    x = x.reshape(x.size(0), -1, x.size(-1))
+    dist = torch.cdist(x, vqvae.embedding.weight[None, :].repeat((x.size(0), 1, 1)))
+    return torch.argmin(dist, dim=-1).view(-1)
+
+
+def chunked_indices(vqvae, x):
+    return vqvae.quantize_indices(x).view(-1)
+
+
+METHODS = {'cdist': cdist_indices, 'chunked': chunked_indices}
+
+
+@torch.inference_mode()
+def run_case(vqvae_config, method, grid, batch_size, repeats, queue):
+    # Runs in a fresh process so the peak RSS belongs to this case alone
+    torch.manual_seed(0)
+    vqvae = VQVAE(im_channels=vqvae_config['im_channels'], model_config=vqvae_config).eval()
+    x = torch.randn(batch_size, vqvae.z_channels, *grid)
+    search = METHODS[method]
+    baseline = peak_rss_mb()
+    indices = search(vqvae, x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        search(vqvae, x)
+    elapsed = (time.perf_counter() - start) / repeats
+    # Before the exact check below, which materialises the full distance matrix itself
+    rss_increase = peak_rss_mb() - baseline
+
+    # Ties and rounding may pick a different code, it must be one at the same distance
+    flat = x.permute(0, 2, 3, 4, 1).reshape(-1, vqvae.z_channels)
+    exact = torch.cdist(flat[None], vqvae.embedding.weight[None])[0]
+    chosen = exact.gather(1, indices[:, None])[:, 0]
+    gap = (chosen - exact.min(dim=1).values).max().item()
+    queue.put({'time_s': elapsed, 'rss_increase_mb': rss_increase, 'max_distance_gap': gap})
+
+
+def measure(*case):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=case + (queue,))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'error': f'exit code {process.exitcode}'}
+    return queue.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cdist vs chunked matmul nearest-codebook search of the VQVAE')
+    parser.add_argument('--config', type=str, default='config/adni.yaml')
+    parser.add_argument('--grid', type=int, nargs=3, default=[30, 36, 30], help='latent grid to quantize')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--chunk', type=int, default=None, help='voxels per search chunk, default from the config')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    vqvae_config = dict(load_config(args.config)['vqvae_params'])
+    if args.chunk is not None:
+        vqvae_config['quantize_chunk'] = args.chunk
+    results = {}
+    for method in METHODS:
+        results[method] = measure(vqvae_config, method, tuple(args.grid), args.batch_size, args.repeats)
+        print(f'{method:8s} grid={tuple(args.grid)} B={args.batch_size} {results[method]}')
+    if all('error' not in result for result in results.values()):
+        print(f"chunked: {results['cdist']['time_s'] / results['chunked']['time_s']:.1f}x faster, "
+              f"{results['chunked']['rss_increase_mb']:.0f} MB vs {results['cdist']['rss_increase_mb']:.0f} MB")
+    assert 'error' not in results['chunked'], results['chunked']
+    assert results['chunked']['max_distance_gap'] <= args.atol, 'chunked search picked a farther code'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import time
+import torch
+from models import const
+from scheduler.linear_noise_scheduler import LinearNoiseScheduler
+
+
+def legacy_sample_prev_timestep(scheduler, xt, noise_pred, t):
+    # The pre-table update: every coefficient is moved to the device on every call
+    # and the noise is drawn on the CPU and copied over
+    x0 = (xt - (scheduler.sqrt_one_minus_alpha_cum_prod.to(xt.device)[t] * noise_pred)) / scheduler.sqrt_alpha_cum_prod.to(xt.device)[t]
+    x0 = torch.clamp(x0, -1., 1.)
+
+    mean = xt - ((scheduler.betas.to(xt.device)[t] * noise_pred) / (scheduler.sqrt_one_minus_alpha_cum_prod.to(xt.device)[t]))
+    mean = mean / torch.sqrt(scheduler.alphas.to(xt.device)[t])
+
+    if t == 0:
+        return mean, x0
+    else:
+        variance = (1 - scheduler.alpha_cum_prod.to(xt.device)[t-1]) / (1. - scheduler.alpha_cum_prod.to(xt.device)[t])
+        variance = variance * scheduler.betas.to(xt.device)[t]
+        sigma = variance ** 0.5
+        z = torch.randn(xt.shape).to(xt.device)
+        return mean + sigma*z, x0
+
+
+def time_loop(step_fn, xt, noise_pred, num_timesteps, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for t in reversed(range(num_timesteps)):
+        xt, _ = step_fn(xt, noise_pred, torch.as_tensor(t).to(device))
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description='Per-step overhead of the scheduler update')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_timesteps', type=int, default=1000)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    scheduler = LinearNoiseScheduler(num_timesteps=args.num_timesteps, beta_start=0.00085, beta_end=0.012,
+                                     ldm_scheduler=True)
+    xt = torch.randn((args.batch_size, *const.LATENT_SHAPE_DM), device=device)
+    noise_pred = torch.randn_like(xt)
+    generator = torch.Generator(device=device).manual_seed(0)
+
+    # Build the device tables outside the timed region, as the worker does on its first job
+    scheduler.tables(device, xt.dtype)
+
+    legacy = time_loop(lambda x, n, t: legacy_sample_prev_timestep(scheduler, x, n, t),
+                       xt, noise_pred, args.num_timesteps, device)
+    tables = time_loop(lambda x, n, t: scheduler.sample_prev_timestep(x, n, t, generator=generator),
+                       xt, noise_pred, args.num_timesteps, device)
+
+    print(f"legacy : {legacy / args.num_timesteps * 1e3:.3f} ms/step ({legacy:.2f}s total)")
+    print(f"tables : {tables / args.num_timesteps * 1e3:.3f} ms/step ({tables:.2f}s total)")
+    print(f"speedup: {legacy / tables:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
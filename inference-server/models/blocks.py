@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 def get_time_embedding(time_steps, t_emb_dim):
 
@@ -15,9 +16,205 @@ def get_time_embedding(time_steps, t_emb_dim):
     t_emb = torch.cat([torch.sin(t_emb), torch.cos(t_emb)], dim = -1)
     return t_emb
 
+class Attention(nn.Module):
+    # Drop-in for nn.MultiheadAttention(batch_first=True) with the same parameter names, so existing
+    # checkpoints load unchanged. Runs F.scaled_dot_product_attention, never builds or returns the
+    # (tokens x tokens) weight matrix, and with chunk_size set attends chunk_size queries at a time
+    def __init__(self, embed_dim, num_heads, bias=True, chunk_size=None):
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.chunk_size = chunk_size
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        if bias:
+            self.in_proj_bias = nn.Parameter(torch.zeros(3 * embed_dim))
+        else:
+            self.register_parameter('in_proj_bias', None)
+        self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        # Same initialisation as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        if bias:
+            nn.init.constant_(self.out_proj.bias, 0.)
+
+    def project(self, x, idx):
+        # idx 0 / 1 / 2 -> query / key / value projection of a (B, L, E) input
+        start, end = idx * self.embed_dim, (idx + 1) * self.embed_dim
+        bias = self.in_proj_bias[start:end] if self.in_proj_bias is not None else None
+        return F.linear(x, self.in_proj_weight[start:end], bias)
+
+    def split_heads(self, x):
+        # (B, L, E) -> (B, num_heads, L, head_dim)
+        return x.reshape(x.size(0), -1, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def attend(self, q, k, v):
+        # Projected (B, L, E) queries against (B, num_heads, S, head_dim) keys/values
+        batch_size, num_tokens, _ = q.shape
+        q = self.split_heads(q)
+        if self.chunk_size is None or num_tokens <= self.chunk_size:
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            out = torch.cat([F.scaled_dot_product_attention(q_chunk, k, v)
+                             for q_chunk in q.split(self.chunk_size, dim=2)], dim=2)
+        out = out.transpose(1, 2).reshape(batch_size, num_tokens, self.embed_dim)
+        return self.out_proj(out)
+
+    def forward(self, query, key, value):
+        if query is key and key is value:
+            q, k, v = F.linear(query, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        else:
+            q, k, v = self.project(query, 0), self.project(key, 1), self.project(value, 2)
+        return self.attend(q, self.split_heads(k), self.split_heads(v))
+
+    def self_attend(self, x, spatial_shape):
+        # (B, d*h*w, E) voxel tokens attending to each other
+        return self(x, x, x)
+
+
+def _window_partition(x, window_size):
+    # (B, D, H, W, C) -> (B * num_windows, wd*wh*ww, C)
+    batch_size, d, h, w, channels = x.shape
+    wd, wh, ww = window_size
+    x = x.reshape(batch_size, d // wd, wd, h // wh, wh, w // ww, ww, channels)
+    return x.permute(0, 1, 3, 5, 2, 4, 6, 7).reshape(-1, wd * wh * ww, channels)
+
+
+def _window_reverse(windows, window_size, batch_size, d, h, w):
+    # Inverse of _window_partition
+    wd, wh, ww = window_size
+    x = windows.reshape(batch_size, d // wd, h // wh, w // ww, wd, wh, ww, -1)
+    return x.permute(0, 1, 4, 2, 5, 3, 6, 7).reshape(batch_size, d, h, w, -1)
+
+
+class WindowAttention(Attention):
+    # Swin-style 3D local self-attention: voxels only attend within non-overlapping
+    # window_size windows, cyclically shifted by shift_size so information crosses window
+    # borders over consecutive layers. Cost is linear in the voxel count. Same parameters
+    # as Attention, so a level can switch between global and windowed attention
+    def __init__(self, embed_dim, num_heads, window_size=4, shift_size=0, bias=True, chunk_size=None):
+        super().__init__(embed_dim, num_heads, bias=bias, chunk_size=chunk_size)
+        self.window_size = tuple(window_size) if isinstance(window_size, (list, tuple)) else (window_size,) * 3
+        self.shift_size = tuple(shift_size) if isinstance(shift_size, (list, tuple)) else (shift_size,) * 3
+        self._masks = {}
+
+    def _windows(self, spatial_shape):
+        # A volume smaller than the window along an axis becomes a single, unshifted window
+        window_size = tuple(min(window, size) for window, size in zip(self.window_size, spatial_shape))
+        shift_size = tuple(0 if size <= window else shift
+                           for window, shift, size in zip(self.window_size, self.shift_size, spatial_shape))
+        return window_size, shift_size
+
+    def _mask(self, spatial_shape, padded_shape, window_size, shift_size, device):
+        # (num_windows, T, T) boolean mask, True where two voxels of a window may attend to each
+        # other, or None when every window is a contiguous block of real voxels
+        if not any(shift_size) and tuple(spatial_shape) == tuple(padded_shape):
+            return None
+        key = (tuple(spatial_shape), device)
+        if key not in self._masks:
+            labels = torch.zeros(padded_shape, dtype=torch.long, device=device)
+            # Regions that the cyclic shift wraps around next to each other (in shifted coordinates)
+            for axis, (size, window, shift) in enumerate(zip(padded_shape, window_size, shift_size)):
+                if shift:
+                    region = torch.zeros(size, dtype=torch.long, device=device)
+                    region[size - window:size - shift] = 1
+                    region[size - shift:] = 2
+                    labels = labels * 3 + region.reshape([-1 if a == axis else 1 for a in range(3)])
+            # Padding voxels form their own region so real voxels never attend to them
+            padding = torch.ones(padded_shape, dtype=torch.long, device=device)
+            padding[:spatial_shape[0], :spatial_shape[1], :spatial_shape[2]] = 0
+            padding = torch.roll(padding, [-s for s in shift_size], dims=(0, 1, 2))
+            labels = labels * 2 + padding
+            labels = _window_partition(labels[None, ..., None], window_size)
+            self._masks[key] = labels == labels.transpose(1, 2)
+        return self._masks[key]
+
+    def self_attend(self, x, spatial_shape):
+        batch_size, _, channels = x.shape
+        d, h, w = spatial_shape
+        window_size, shift_size = self._windows(spatial_shape)
+        wd, wh, ww = window_size
+        x = x.reshape(batch_size, d, h, w, channels)
+        pad = ((wd - d % wd) % wd, (wh - h % wh) % wh, (ww - w % ww) % ww)
+        if any(pad):
+            x = F.pad(x, (0, 0, 0, pad[2], 0, pad[1], 0, pad[0]))
+        padded_shape = (d + pad[0], h + pad[1], w + pad[2])
+        if any(shift_size):
+            x = torch.roll(x, [-s for s in shift_size], dims=(1, 2, 3))
+
+        windows = _window_partition(x, window_size)
+        mask = self._mask(spatial_shape, padded_shape, window_size, shift_size, x.device)
+        q, k, v = F.linear(windows, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = self.split_heads(q), self.split_heads(k), self.split_heads(v)
+        if mask is not None:
+            # (num_windows, T, T) -> (B * num_windows, 1, T, T)
+            mask = mask[:, None].repeat(batch_size, 1, 1, 1)
+
+        # chunk_size counts query voxels, here it bounds how many windows are attended at once
+        tokens = windows.size(1)
+        step = windows.size(0) if self.chunk_size is None else max(1, self.chunk_size // tokens)
+        out = []
+        for start in range(0, windows.size(0), step):
+            out.append(F.scaled_dot_product_attention(
+                q[start:start + step], k[start:start + step], v[start:start + step],
+                attn_mask=mask[start:start + step] if mask is not None else None))
+        out = torch.cat(out, dim=0).transpose(1, 2).reshape(-1, tokens, self.embed_dim)
+        out = self.out_proj(out)
+
+        x = _window_reverse(out, window_size, batch_size, *padded_shape)
+        if any(shift_size):
+            x = torch.roll(x, list(shift_size), dims=(1, 2, 3))
+        x = x[:, :d, :h, :w]
+        return x.reshape(batch_size, d * h * w, channels)
+
+
+ATTENTION_KINDS = ('global', 'window')
+
+
+def make_self_attention(channels, num_heads, attn_kind='global', window_size=4, layer=0):
+    # attn_kind per level: 'global' attends over every voxel, 'window' within local 3D windows,
+    # shifted by half a window on every other layer
+    assert attn_kind in ATTENTION_KINDS, f"Unknown attention kind '{attn_kind}', expected one of {ATTENTION_KINDS}"
+    if attn_kind == 'global':
+        return Attention(channels, num_heads)
+    window_size = tuple(window_size) if isinstance(window_size, (list, tuple)) else (window_size,) * 3
+    shift_size = tuple(size // 2 for size in window_size) if layer % 2 else 0
+    return WindowAttention(channels, num_heads, window_size=window_size, shift_size=shift_size)
+
+
+def set_attention_chunk_size(model, chunk_size):
+    # Query chunk size for every attention layer of a model (None attends all queries at once)
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.chunk_size = chunk_size
+
+
+def project_context_kv(attention, context_proj):
+    # Key/value projections of a (B, L, E) context
+    return attention.project(context_proj, 1), attention.project(context_proj, 2)
+
+
+def cached_cross_attention(norm, attention, out, context_kv):
+    # Same result as the cross attention block in DownBlockUnet/MidBlockUnet, but with
+    # key/value projections precomputed once per job by project_context_kv
+    batch_size, channels, d, h, w = out.shape
+    k, v = context_kv
+    if k.size(1) == 1:
+        # A single context token takes all the attention weight, so every voxel receives
+        # the same projected value and the queries never need to be computed
+        return attention.out_proj(v).transpose(1, 2).reshape(batch_size, channels, 1, 1, 1)
+
+    in_attn = out.reshape(batch_size, channels, d * h * w)
+    in_attn = norm(in_attn).transpose(1, 2)
+    out_attn = attention.attend(attention.project(in_attn, 0),
+                                attention.split_heads(k), attention.split_heads(v))
+    return out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
+
+
 class DownBlock(nn.Module):
     def __init__(self, in_channels, out_channels, t_emb_dim,
-                 down_sample, num_heads, num_layers, attn, norm_channels, cross_attn=False, context_dim=None):
+                 down_sample, num_heads, num_layers, attn, norm_channels, cross_attn=False, context_dim=None,
+                 attn_kind='global', window_size=4):
         super().__init__()
         self.num_layers = num_layers
         self.down_sample = down_sample
@@ -62,8 +259,8 @@ class DownBlock(nn.Module):
                  for _ in range(num_layers)]
             )
             self.attentions = nn.ModuleList(
-                [nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
-                for _ in range(num_layers)]
+                [make_self_attention(out_channels, num_heads, attn_kind, window_size, i)
+                for i in range(num_layers)]
             )
 
         if self.cross_attn:
@@ -73,7 +270,7 @@ class DownBlock(nn.Module):
                  for _ in range(num_layers)]
             )
             self.cross_attentions = nn.ModuleList(
-                [nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
+                [Attention(out_channels, num_heads)
                  for _ in range(num_layers)]
             )
             self.context_proj = nn.ModuleList(
@@ -113,7 +310,7 @@ class DownBlock(nn.Module):
                 in_attn = self.attention_norms[i](in_attn) # normalize before softmax of attention
                 # self.attention(q, k, v) input shape: (B, seq_len, emb_dim) -> change 2nd, 3rd dimension
                 in_attn = in_attn.transpose(1, 2)
-                out_attn, _ = self.attentions[i](in_attn, in_attn, in_attn) # query, key, value (self-attention -> all in_attn)
+                out_attn = self.attentions[i].self_attend(in_attn, (d, h, w)) # self-attention over all voxels, or within local windows
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w) # reconstruct to original shape
                 out = out + out_attn # skip connection
 
@@ -125,7 +322,7 @@ class DownBlock(nn.Module):
                 in_attn = in_attn.transpose(1, 2)
                 assert context.shape[0] == x.shape[0] and context.shape[-1] == self.context_dim
                 context_proj = self.context_proj[i](context)
-                out_attn, _ = self.cross_attentions[i](in_attn, context_proj, context_proj)
+                out_attn = self.cross_attentions[i](in_attn, context_proj, context_proj)
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
                 out = out + out_attn
 
@@ -134,7 +331,8 @@ class DownBlock(nn.Module):
         return out
 
 class MidBlock(nn.Module):
-    def __init__(self, in_channels, out_channels, t_emb_dim, num_heads, num_layers, attn, norm_channels, cross_attn=None, context_dim=None):
+    def __init__(self, in_channels, out_channels, t_emb_dim, num_heads, num_layers, attn, norm_channels, cross_attn=None, context_dim=None,
+                 attn_kind='global', window_size=4):
         super().__init__()
         self.num_layers = num_layers
         self.t_emb_dim = t_emb_dim
@@ -177,8 +375,8 @@ class MidBlock(nn.Module):
                  for _ in range(num_layers)]
             )
             self.attentions = nn.ModuleList([
-                nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
-                for _ in range(num_layers)
+                make_self_attention(out_channels, num_heads, attn_kind, window_size, i)
+                for i in range(num_layers)
             ])
 
         if self.cross_attn:
@@ -188,7 +386,7 @@ class MidBlock(nn.Module):
                  for _ in range(num_layers)]
             )
             self.cross_attentions = nn.ModuleList(
-                [nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
+                [Attention(out_channels, num_heads)
                  for _ in range(num_layers)]
             )
             self.context_proj = nn.ModuleList(
@@ -221,7 +419,7 @@ class MidBlock(nn.Module):
                 in_attn = out.reshape(batch_size, channels, d*h*w)
                 in_attn = self.attention_norms[i](in_attn)
                 in_attn = in_attn.transpose(1, 2)
-                out_attn, _ = self.attentions[i](in_attn, in_attn, in_attn)
+                out_attn = self.attentions[i].self_attend(in_attn, (d, h, w))
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
                 out = out + out_attn
 
@@ -233,7 +431,7 @@ class MidBlock(nn.Module):
                 in_attn = in_attn.transpose(1, 2)
                 assert context.shape[0] == x.shape[0] and context.shape[-1] == self.context_dim
                 context_proj = self.context_proj[i](context)
-                out_attn, _ = self.cross_attentions[i](in_attn, context_proj, context_proj)
+                out_attn = self.cross_attentions[i](in_attn, context_proj, context_proj)
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
                 out = out + out_attn
 
@@ -250,7 +448,8 @@ class MidBlock(nn.Module):
 
 class UpBlock(nn.Module):
     def __init__(self, in_channels, out_channels, t_emb_dim,
-                 up_sample, num_heads, num_layers, attn, norm_channels):
+                 up_sample, num_heads, num_layers, attn, norm_channels,
+                 attn_kind='global', window_size=4):
         super().__init__()
         self.num_layers = num_layers
         self.up_sample = up_sample
@@ -296,8 +495,8 @@ class UpBlock(nn.Module):
 
             self.attentions = nn.ModuleList(
                 [
-                    nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
-                    for _ in range(num_layers)
+                    make_self_attention(out_channels, num_heads, attn_kind, window_size, i)
+                    for i in range(num_layers)
                 ]
             )
 
@@ -338,7 +537,7 @@ class UpBlock(nn.Module):
                 in_attn = self.attention_norms[i](in_attn)
                 # self.attention(q, k, v) input shape: (B, seq_len, emb_dim) -> change 2nd, 3rd dimension
                 in_attn = in_attn.transpose(1, 2)
-                out_attn, _ = self.attentions[i](in_attn, in_attn, in_attn)  # query, key, value (self-attention -> all in_attn)
+                out_attn = self.attentions[i].self_attend(in_attn, (d, h, w))  # self-attention over all voxels, or within local windows
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)  # reconstruct to original shape
                 out = out + out_attn  # skip connection
 
@@ -347,7 +546,8 @@ class UpBlock(nn.Module):
 
 class DownBlockUnet(nn.Module):
     def __init__(self, in_channels, out_channels, t_emb_dim,
-                 down_sample, num_heads, num_layers, attn, norm_channels, cross_attn=False, context_dim=None):
+                 down_sample, num_heads, num_layers, attn, norm_channels, cross_attn=False, context_dim=None,
+                 attn_kind='global', window_size=4):
         super().__init__()
         self.num_layers = num_layers
         self.down_sample = down_sample
@@ -392,8 +592,8 @@ class DownBlockUnet(nn.Module):
                  for _ in range(num_layers)]
             )
             self.attentions = nn.ModuleList(
-                [nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
-                for _ in range(num_layers)]
+                [make_self_attention(out_channels, num_heads, attn_kind, window_size, i)
+                for i in range(num_layers)]
             )
 
         if self.cross_attn:
@@ -403,7 +603,7 @@ class DownBlockUnet(nn.Module):
                  for _ in range(num_layers)]
             )
             self.cross_attentions = nn.ModuleList(
-                [nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
+                [Attention(out_channels, num_heads)
                  for _ in range(num_layers)]
             )
             self.context_proj = nn.ModuleList(
@@ -420,7 +620,19 @@ class DownBlockUnet(nn.Module):
         self.down_sample_conv = nn.Conv3d(out_channels, out_channels, kernel_size=4,
                                           stride=2, padding=1) if self.down_sample else nn.Identity()
 
-    def forward(self, x, t_emb=None, context=None):
+    def project_context(self, context):
+        # Per-layer cross attention key/value for a context that stays fixed over the sampling loop
+        if not self.cross_attn:
+            return None
+        context_kv = []
+        for i in range(self.num_layers):
+            context_proj = self.context_proj[i](context)
+            if context_proj.dim() == 2:
+                context_proj = context_proj.unsqueeze(1)
+            context_kv.append(project_context_kv(self.cross_attentions[i], context_proj))
+        return context_kv
+
+    def forward(self, x, t_emb=None, context=None, context_kv=None):
         out = x
 
         for i in range(self.num_layers):
@@ -445,11 +657,14 @@ class DownBlockUnet(nn.Module):
                 in_attn = self.attention_norms[i](in_attn) # normalize before softmax of attention
                 # self.attention(q, k, v) input shape: (B, seq_len, emb_dim) -> change 2nd, 3rd dimension
                 in_attn = in_attn.transpose(1, 2)
-                out_attn, _ = self.attentions[i](in_attn, in_attn, in_attn) # query, key, value (self-attention -> all in_attn)
+                out_attn = self.attentions[i].self_attend(in_attn, (d, h, w)) # self-attention over all voxels, or within local windows
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w) # reconstruct to original shape
                 out = out + out_attn # skip connection
 
-            if self.cross_attn:
+            if self.cross_attn and context_kv is not None:
+                out = out + cached_cross_attention(self.cross_attention_norms[i], self.cross_attentions[i],
+                                                   out, context_kv[i])
+            elif self.cross_attn:
                 assert context is not None, "context cannot be None if cross attention layers are used"
                 batch_size, channels, d, h, w = out.shape
                 in_attn = out.reshape(batch_size, channels, d * h * w)
@@ -459,7 +674,7 @@ class DownBlockUnet(nn.Module):
                 context_proj = self.context_proj[i](context)
                 if context_proj.dim() == 2:
                     context_proj = context_proj.unsqueeze(1)
-                out_attn, _ = self.cross_attentions[i](in_attn, context_proj, context_proj)
+                out_attn = self.cross_attentions[i](in_attn, context_proj, context_proj)
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
                 out = out + out_attn
 
@@ -468,7 +683,8 @@ class DownBlockUnet(nn.Module):
         return out
 
 class MidBlockUnet(nn.Module):
-    def __init__(self, in_channels, out_channels, t_emb_dim, num_heads, num_layers, attn, norm_channels, cross_attn=None, context_dim=None):
+    def __init__(self, in_channels, out_channels, t_emb_dim, num_heads, num_layers, attn, norm_channels, cross_attn=None, context_dim=None,
+                 attn_kind='global', window_size=4):
         super().__init__()
         self.num_layers = num_layers
         self.t_emb_dim = t_emb_dim
@@ -512,8 +728,8 @@ class MidBlockUnet(nn.Module):
                  for _ in range(num_layers)]
             )
             self.attentions = nn.ModuleList([
-                nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
-                for _ in range(num_layers)
+                make_self_attention(out_channels, num_heads, attn_kind, window_size, i)
+                for i in range(num_layers)
             ])
 
         if self.cross_attn:
@@ -523,7 +739,7 @@ class MidBlockUnet(nn.Module):
                  for _ in range(num_layers)]
             )
             self.cross_attentions = nn.ModuleList(
-                [nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
+                [Attention(out_channels, num_heads)
                  for _ in range(num_layers)]
             )
             self.context_proj = nn.ModuleList(
@@ -538,7 +754,19 @@ class MidBlockUnet(nn.Module):
             ]
         )
 
-    def forward(self, x, t_emb=None, context=None):
+    def project_context(self, context):
+        # Per-layer cross attention key/value for a context that stays fixed over the sampling loop
+        if not self.cross_attn:
+            return None
+        context_kv = []
+        for i in range(self.num_layers):
+            context_proj = self.context_proj[i](context)
+            if context_proj.dim() == 2:
+                context_proj = context_proj.unsqueeze(1)
+            context_kv.append(project_context_kv(self.cross_attentions[i], context_proj))
+        return context_kv
+
+    def forward(self, x, t_emb=None, context=None, context_kv=None):
         out = x
         # first resnet block
         resnet_input = out
@@ -557,11 +785,14 @@ class MidBlockUnet(nn.Module):
                 in_attn = out.reshape(batch_size, channels, d*h*w)
                 in_attn = self.attention_norms[i](in_attn)
                 in_attn = in_attn.transpose(1, 2)
-                out_attn, _ = self.attentions[i](in_attn, in_attn, in_attn)
+                out_attn = self.attentions[i].self_attend(in_attn, (d, h, w))
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
                 out = out + out_attn
 
-            if self.cross_attn:
+            if self.cross_attn and context_kv is not None:
+                out = out + cached_cross_attention(self.cross_attention_norms[i], self.cross_attentions[i],
+                                                   out, context_kv[i])
+            elif self.cross_attn:
                 assert context is not None, "context cannot be None if cross attention layers are used"
                 batch_size, channels, d, h, w = out.shape
                 in_attn = out.reshape(batch_size, channels, d * h * w)
@@ -571,7 +802,7 @@ class MidBlockUnet(nn.Module):
                 context_proj = self.context_proj[i](context)
                 if context_proj.dim() == 2:
                     context_proj = context_proj.unsqueeze(1)
-                out_attn, _ = self.cross_attentions[i](in_attn, context_proj, context_proj)
+                out_attn = self.cross_attentions[i](in_attn, context_proj, context_proj)
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
                 out = out + out_attn
 
@@ -590,7 +821,8 @@ class MidBlockUnet(nn.Module):
 
 class UpBlockUnet(nn.Module):
     def __init__(self, in_channels, skip_channels, out_channels, t_emb_dim,
-                 up_sample, num_heads, num_layers, attn, norm_channels):
+                 up_sample, num_heads, num_layers, attn, norm_channels,
+                 attn_kind='global', window_size=4):
         super().__init__()
         self.num_layers = num_layers
         self.up_sample = up_sample
@@ -640,8 +872,8 @@ class UpBlockUnet(nn.Module):
 
             self.attentions = nn.ModuleList(
                 [
-                    nn.MultiheadAttention(out_channels, num_heads, batch_first=True)
-                    for _ in range(num_layers)
+                    make_self_attention(out_channels, num_heads, attn_kind, window_size, i)
+                    for i in range(num_layers)
                 ]
             )
 
@@ -684,7 +916,7 @@ class UpBlockUnet(nn.Module):
                 in_attn = self.attention_norms[i](in_attn)
                 # self.attention(q, k, v) input shape: (B, seq_len, emb_dim) -> change 2nd, 3rd dimension
                 in_attn = in_attn.transpose(1, 2)
-                out_attn, _ = self.attentions[i](in_attn, in_attn, in_attn)  # query, key, value (self-attention -> all in_attn)
+                out_attn = self.attentions[i].self_attend(in_attn, (d, h, w))  # self-attention over all voxels, or within local windows
                 out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)  # reconstruct to original shape
                 out = out + out_attn  # skip connection
 
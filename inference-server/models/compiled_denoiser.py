@@ -0,0 +1,123 @@
+import os
+import hashlib
+import torch
+import torch.nn as nn
+from models import const
+
+
+class DenoiserWrapper(nn.Module):
+    # Plain tensor-in / tensor-out view of ControlNet.forward for tracing and export
+    def __init__(self, controlnet):
+        super().__init__()
+        self.controlnet = controlnet
+
+    def forward(self, x, t, context, hint):
+        return self.controlnet(x, t, context, hint)
+
+
+def example_inputs(batch_size, context_dim, hint_channels, device):
+    x = torch.randn((batch_size, *const.LATENT_SHAPE_DM), device=device)
+    t = torch.full((batch_size,), 500, dtype=torch.long, device=device)
+    context = torch.rand((batch_size, context_dim), device=device)
+    hint = torch.randn((batch_size, hint_channels, *const.LATENT_SHAPE_DM[1:]), device=device)
+    return x, t, context, hint
+
+
+def artifact_path(cache_dir, backend, batch_size, fingerprint):
+    extension = 'pt2' if backend == 'export' else 'pt'
+    return os.path.join(cache_dir, f"controlnet_{backend}_b{batch_size}_{fingerprint}.{extension}")
+
+
+def make_fingerprint(*parts):
+    # Artifacts are only valid for the same weights, input shape and torch build
+    key = '|'.join(str(p) for p in parts + (const.LATENT_SHAPE_DM, torch.__version__))
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+@torch.no_grad()
+def max_abs_error(reference, candidate, inputs):
+    return (reference(*inputs) - candidate(*inputs)).abs().max().item()
+
+
+@torch.no_grad()
+def _trace(wrapper, inputs, path):
+    if os.path.exists(path):
+        print(f'Loading traced controlnet from {path}')
+        return torch.jit.load(path, map_location=inputs[0].device)
+    traced = torch.jit.trace(wrapper, inputs, check_trace=False)
+    traced = torch.jit.freeze(traced.eval())
+    torch.jit.save(traced, path)
+    print(f'Saved traced controlnet to {path}')
+    return traced
+
+
+@torch.no_grad()
+def _export(wrapper, inputs, path):
+    if os.path.exists(path):
+        print(f'Loading exported controlnet from {path}')
+        return torch.export.load(path).module()
+    exported = torch.export.export(wrapper, inputs)
+    torch.export.save(exported, path)
+    print(f'Saved exported controlnet to {path}')
+    return exported.module()
+
+
+@torch.no_grad()
+def _inductor(wrapper, inputs, cache_dir):
+    # Inductor keeps its compiled kernels and FX graphs in an on-disk cache,
+    # so a restarted pod only pays for the dynamo trace
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    compiled = torch.compile(wrapper, backend='inductor', dynamic=False)
+    compiled(*inputs)
+    return compiled
+
+
+# Dispatches to a compiled ControlNet for the batch sizes it was built for, and to the
+# eager module (which can still use the inference cache) for anything else. The compiled graphs
+# take no cache, callers skip building one for those batch sizes (LoadedModels.compiled_batch_sizes)
+class CompiledDenoiser:
+    def __init__(self, controlnet, compiled):
+        self.controlnet = controlnet
+        self.compiled = compiled
+
+    def __call__(self, x, t, context, hint, cache=None):
+        compiled = self.compiled.get(x.size(0))
+        if compiled is None or tuple(x.shape[1:]) != tuple(const.LATENT_SHAPE_DM):
+            return self.controlnet(x, t, context, hint, cache=cache)
+        t = torch.as_tensor(t, device=x.device).long().expand(x.size(0))
+        return compiled(x, t, context, hint)
+
+
+def compile_denoiser(controlnet, batch_sizes, context_dim, hint_channels, device,
+                     backend='inductor', cache_dir='checkpoints/compiled', fingerprint='', parity_atol=1e-3):
+    os.makedirs(cache_dir, exist_ok=True)
+    wrapper = DenoiserWrapper(controlnet).eval()
+    compiled = {}
+    for batch_size in batch_sizes:
+        inputs = example_inputs(batch_size, context_dim, hint_channels, device)
+        path = artifact_path(cache_dir, backend, batch_size, fingerprint)
+        try:
+            if backend == 'inductor':
+                module = _inductor(wrapper, inputs, cache_dir)
+            elif backend == 'trace':
+                module = _trace(wrapper, inputs, path)
+            elif backend == 'export':
+                module = _export(wrapper, inputs, path)
+            else:
+                raise ValueError(f"Unknown compile backend '{backend}'")
+        except Exception as e:
+            print(f"[ERROR] Failed to compile controlnet ({backend}, batch {batch_size}): {e}")
+            continue
+
+        # Never serve a compiled artifact that disagrees with the eager model
+        error = max_abs_error(wrapper, module, inputs)
+        if error > parity_atol:
+            print(f"[ERROR] Compiled controlnet ({backend}, batch {batch_size}) differs from eager "
+                  f"by {error:.2e} > {parity_atol:.0e}, using eager")
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        print(f'Compiled controlnet ({backend}, batch {batch_size}), max abs error vs eager {error:.2e}')
+        compiled[batch_size] = module
+    return CompiledDenoiser(controlnet, compiled)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from models.unet_cond import UNet
 from models.blocks import get_time_embedding
+from models.fused_encoder import FusedControlNetEncoder
 
 
 def make_zero_module(module):
@@ -10,34 +11,66 @@ def make_zero_module(module):
     return module
 
 
+class InferenceCache:
+    # Everything ControlNet.forward computes that stays fixed over one job's sampling loop:
+    # timestep embeddings of the whole schedule for both unets, the cross attention key/value
+    # of the covariate context and the hint block output
+    def __init__(self, trained_t_emb, control_t_emb, context_kv, hint_out):
+        self.trained_t_emb = trained_t_emb
+        self.control_t_emb = control_t_emb
+        self.context_kv = context_kv
+        self.hint_out = hint_out
+
+    @staticmethod
+    def concat(caches):
+        # Stack per-job caches along the batch dimension (timestep tables are shared by all jobs)
+        if len(caches) == 1:
+            return caches[0]
+
+        def concat_kv(blocks_kv):
+            if blocks_kv[0] is None:
+                return None
+            return [(torch.cat([kv[i][0] for kv in blocks_kv], dim=0),
+                     torch.cat([kv[i][1] for kv in blocks_kv], dim=0))
+                    for i in range(len(blocks_kv[0]))]
+
+        context_kv = {name: [concat_kv([c.context_kv[name][j] for c in caches])
+                             for j in range(len(blocks))]
+                      for name, blocks in caches[0].context_kv.items()}
+        return InferenceCache(caches[0].trained_t_emb, caches[0].control_t_emb, context_kv,
+                              torch.cat([c.hint_out for c in caches], dim=0))
+
+
 class ControlNet(nn.Module):
 
     def __init__(self, im_channels,
                  model_config,
                  model_locked=True,
                  model_ckpt=None,
-                 device=None):
+                 device=None,
+                 model_state_dict=None):
         super().__init__()
         # Trained DDPM
         self.model_locked = model_locked
         self.trained_unet = UNet(im_channels, model_config)
 
-        # Load weights for the trained model
-        if model_ckpt is not None and device is not None:
+        # Parse the trained model checkpoint once and share it between both unet copies
+        if model_state_dict is None and model_ckpt is not None and device is not None:
             print('Loading Trained Diffusion Model')
             ckpt = torch.load(model_ckpt, map_location=device)
-            state_dict = ckpt['model_state_dict']
-            self.trained_unet.load_state_dict(state_dict, strict=True)
+            model_state_dict = ckpt['model_state_dict']
+
+        # Load weights for the trained model
+        if model_state_dict is not None:
+            self.trained_unet.load_state_dict(model_state_dict, strict=True)
 
         # ControlNet Copy of Trained DDPM
         # use_up = False removes the upblocks(decoder layers) from DDPM Unet
         self.control_unet = UNet(im_channels, model_config, use_up=False)
         # Load same weights as the trained model
-        if model_ckpt is not None and device is not None:
+        if model_state_dict is not None:
             print('Loading ControlNet Diffusion Model')
-            ckpt = torch.load(model_ckpt, map_location=device)
-            state_dict = ckpt['model_state_dict']
-            self.control_unet.load_state_dict(state_dict, strict=False)
+            self.control_unet.load_state_dict(model_state_dict, strict=False)
 
         ######### Hint Block for ControlNet ##########
         hint = model_config['hint_channels']
@@ -68,6 +101,10 @@ class ControlNet(nn.Module):
         for p in self.trained_unet.parameters():
             p.requires_grad_(False)
 
+        # Optional inference-only fused encoder, kept out of the module tree so
+        # state dicts and checkpoints are unaffected
+        object.__setattr__(self, 'fused_encoder', None)
+
     def get_params(self):
         # Add all ControlNet parameters
         # First is our copy of unet
@@ -86,34 +123,46 @@ class ControlNet(nn.Module):
             params += list(self.trained_unet.conv_out.parameters())
         return params
 
-    def forward(self, x, t, context, hint):
-        # Time embedding and timestep projection layers of trained unet
-        trained_unet_t_emb = get_time_embedding(torch.as_tensor(t).long(),
-                                                self.trained_unet.t_emb_dim)
-        trained_unet_t_emb = self.trained_unet.t_proj(trained_unet_t_emb)
+    @torch.no_grad()
+    def enable_fused_encoder(self):
+        # Must be called after the weights are loaded and the model is on its device,
+        # the fused layers hold a copy of both encoders' weights
+        object.__setattr__(self, 'fused_encoder', FusedControlNetEncoder(self).eval())
+
+    def disable_fused_encoder(self):
+        object.__setattr__(self, 'fused_encoder', None)
+
+    @torch.no_grad()
+    def build_inference_cache(self, context, hint, num_timesteps, dtype=None):
+        # Precompute the per-job constants of forward() so the sampling loop can skip them
+        device = hint.device
+        dtype = dtype or next(self.parameters()).dtype
+        timesteps = torch.arange(num_timesteps, device=device)
+        trained_t_emb = self.trained_unet.t_proj(get_time_embedding(timesteps, self.trained_unet.t_emb_dim))
+        control_t_emb = self.control_unet.t_proj(get_time_embedding(timesteps, self.control_unet.t_emb_dim))
 
-        # Get all downblocks output of trained unet
-        trained_unet_down_outs = []
         if context.dim() == 2:
             context = context.unsqueeze(1)
+        context_kv = {
+            'trained_downs': [down.project_context(context) for down in self.trained_unet.downs],
+            'trained_mids': [mid.project_context(context) for mid in self.trained_unet.mids],
+            'control_downs': [down.project_context(context) for down in self.control_unet.downs],
+            'control_mids': [mid.project_context(context) for mid in self.control_unet.mids],
+        }
+        hint_out = self.control_unet_hint_block(hint.to(dtype=dtype))
+        return InferenceCache(trained_t_emb, control_t_emb, context_kv, hint_out)
+
+    def _encode(self, x, trained_unet_t_emb, control_unet_t_emb, context, control_unet_hint_out,
+                trained_downs_kv, control_downs_kv, trained_mids_kv, control_mids_kv):
+        # Get all downblocks output of trained unet
+        trained_unet_down_outs = []
         with torch.no_grad():
             train_unet_out = self.trained_unet.conv_in(x)
             for idx, down in enumerate(self.trained_unet.downs):
                 trained_unet_down_outs.append(train_unet_out)
-                train_unet_out = down(train_unet_out, trained_unet_t_emb, context)
+                train_unet_out = down(train_unet_out, trained_unet_t_emb, context, trained_downs_kv[idx])
 
         ############# ControlNet Layers #############
-        # Time embedding and timestep projection layers of controlnet copy of unet
-        control_unet_t_emb = get_time_embedding(torch.as_tensor(t).long(),
-                                                self.control_unet.t_emb_dim)
-        control_unet_t_emb = self.control_unet.t_proj(control_unet_t_emb)
-
-        if hint.dtype != x.dtype:
-            hint = hint.to(dtype=x.dtype)
-
-        # Hint block of controlnet copy of unet
-        control_unet_hint_out = self.control_unet_hint_block(hint)
-
         # Call conv_in layer for controlnet copy of unet
         # and add hint blocks output to it
         control_unet_out = self.control_unet.conv_in(x)
@@ -124,19 +173,68 @@ class ControlNet(nn.Module):
         for idx, down in enumerate(self.control_unet.downs):
             # Controlnet copy output -> pass zero conv layers -> save it in list
             control_unet_down_outs.append(self.control_unet_down_zero_convs[idx](control_unet_out))
-            control_unet_out = down(control_unet_out, control_unet_t_emb, context)
+            control_unet_out = down(control_unet_out, control_unet_t_emb, context, control_downs_kv[idx])
 
         for idx in range(len(self.control_unet.mids)):
             # Get midblock output of controlnet copy
-            control_unet_out = self.control_unet.mids[idx](control_unet_out, control_unet_t_emb, context)
+            control_unet_out = self.control_unet.mids[idx](control_unet_out, control_unet_t_emb, context,
+                                                           control_mids_kv[idx])
 
             # Get midblock output of trained unet
-            train_unet_out = self.trained_unet.mids[idx](train_unet_out, trained_unet_t_emb, context)
+            train_unet_out = self.trained_unet.mids[idx](train_unet_out, trained_unet_t_emb, context,
+                                                         trained_mids_kv[idx])
 
             # Controlnet copy midblock output -> pass zero conv layers
             # -> added to trained unet midblock output
             train_unet_out += self.control_unet_mid_zero_convs[idx](control_unet_out)
 
+        return train_unet_out, trained_unet_down_outs, control_unet_down_outs
+
+    def forward(self, x, t, context, hint, cache=None):
+        if cache is not None:
+            t = torch.as_tensor(t).long()
+            trained_unet_t_emb = cache.trained_t_emb[t]
+            control_unet_t_emb = cache.control_t_emb[t]
+            trained_downs_kv = cache.context_kv['trained_downs']
+            trained_mids_kv = cache.context_kv['trained_mids']
+            control_downs_kv = cache.context_kv['control_downs']
+            control_mids_kv = cache.context_kv['control_mids']
+        else:
+            # Time embedding and timestep projection layers of trained unet
+            trained_unet_t_emb = get_time_embedding(torch.as_tensor(t).long(),
+                                                    self.trained_unet.t_emb_dim)
+            trained_unet_t_emb = self.trained_unet.t_proj(trained_unet_t_emb)
+            # Time embedding and timestep projection layers of controlnet copy of unet
+            control_unet_t_emb = get_time_embedding(torch.as_tensor(t).long(),
+                                                    self.control_unet.t_emb_dim)
+            control_unet_t_emb = self.control_unet.t_proj(control_unet_t_emb)
+            trained_downs_kv = [None] * len(self.trained_unet.downs)
+            trained_mids_kv = [None] * len(self.trained_unet.mids)
+            control_downs_kv = [None] * len(self.control_unet.downs)
+            control_mids_kv = [None] * len(self.control_unet.mids)
+
+        if context.dim() == 2:
+            context = context.unsqueeze(1)
+
+        if cache is not None:
+            control_unet_hint_out = cache.hint_out
+        else:
+            if hint.dtype != x.dtype:
+                hint = hint.to(dtype=x.dtype)
+
+            # Hint block of controlnet copy of unet
+            control_unet_hint_out = self.control_unet_hint_block(hint)
+
+        if self.fused_encoder is not None:
+            # Trained unet and controlnet copy encoders in one pass of grouped convolutions
+            train_unet_out, trained_unet_down_outs, control_unet_down_outs = self.fused_encoder(
+                x, trained_unet_t_emb, control_unet_t_emb, context, control_unet_hint_out,
+                trained_downs_kv, control_downs_kv, trained_mids_kv, control_mids_kv)
+        else:
+            train_unet_out, trained_unet_down_outs, control_unet_down_outs = self._encode(
+                x, trained_unet_t_emb, control_unet_t_emb, context, control_unet_hint_out,
+                trained_downs_kv, control_downs_kv, trained_mids_kv, control_mids_kv)
+
         # Upblocks of trained unet
         for up in self.trained_unet.ups:
             # Get downblock outputs from trained unet and controlnet copy
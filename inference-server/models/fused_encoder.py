@@ -0,0 +1,185 @@
+import torch
+import torch.nn as nn
+from models.blocks import cached_cross_attention
+
+
+# The trained unet and its controlnet copy share one architecture, so every conv / group norm
+# of the two encoders can run as a single grouped layer over the channel-concatenated
+# activations [trained | control]. Attention layers keep their own weights and run per half.
+
+
+def fuse_conv(a, b):
+    # Two convs over different inputs -> one conv with twice the groups
+    fused = nn.Conv3d(a.in_channels * 2, a.out_channels * 2, a.kernel_size,
+                      stride=a.stride, padding=a.padding, dilation=a.dilation,
+                      groups=a.groups * 2, bias=a.bias is not None,
+                      device=a.weight.device, dtype=a.weight.dtype)
+    fused.weight.copy_(torch.cat([a.weight, b.weight], dim=0))
+    if a.bias is not None:
+        fused.bias.copy_(torch.cat([a.bias, b.bias], dim=0))
+    return fused
+
+
+def fuse_shared_input_conv(a, b):
+    # Two convs over the same input -> one conv with twice the output channels
+    fused = nn.Conv3d(a.in_channels, a.out_channels * 2, a.kernel_size,
+                      stride=a.stride, padding=a.padding, dilation=a.dilation,
+                      groups=a.groups, bias=a.bias is not None,
+                      device=a.weight.device, dtype=a.weight.dtype)
+    fused.weight.copy_(torch.cat([a.weight, b.weight], dim=0))
+    if a.bias is not None:
+        fused.bias.copy_(torch.cat([a.bias, b.bias], dim=0))
+    return fused
+
+
+def fuse_group_norm(a, b):
+    # Groups never straddle the [trained | control] boundary, so doubling them is exact
+    fused = nn.GroupNorm(a.num_groups * 2, a.num_channels * 2, eps=a.eps, affine=a.affine,
+                         device=a.weight.device if a.affine else None,
+                         dtype=a.weight.dtype if a.affine else None)
+    if a.affine:
+        fused.weight.copy_(torch.cat([a.weight, b.weight], dim=0))
+        fused.bias.copy_(torch.cat([a.bias, b.bias], dim=0))
+    return fused
+
+
+def fuse_norm_act_conv(a, b):
+    # nn.Sequential(GroupNorm, SiLU, Conv3d) as used by the resnet blocks
+    return nn.Sequential(fuse_group_norm(a[0], b[0]), nn.SiLU(), fuse_conv(a[2], b[2]))
+
+
+def fuse_optional_conv(a, b):
+    if isinstance(a, nn.Identity):
+        return nn.Identity()
+    return fuse_conv(a, b)
+
+
+def self_attention(norm, attention, out):
+    batch_size, channels, d, h, w = out.shape
+    in_attn = out.reshape(batch_size, channels, d * h * w)
+    in_attn = norm(in_attn)
+    in_attn = in_attn.transpose(1, 2)
+    out_attn = attention.self_attend(in_attn, (d, h, w))
+    out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
+    return out + out_attn
+
+
+def cross_attention(norm, attention, context_proj_layer, out, context, context_kv):
+    if context_kv is not None:
+        return out + cached_cross_attention(norm, attention, out, context_kv)
+    batch_size, channels, d, h, w = out.shape
+    in_attn = out.reshape(batch_size, channels, d * h * w)
+    in_attn = norm(in_attn)
+    in_attn = in_attn.transpose(1, 2)
+    context_proj = context_proj_layer(context)
+    if context_proj.dim() == 2:
+        context_proj = context_proj.unsqueeze(1)
+    out_attn = attention(in_attn, context_proj, context_proj)
+    out_attn = out_attn.transpose(1, 2).reshape(batch_size, channels, d, h, w)
+    return out + out_attn
+
+
+class FusedBlock(nn.Module):
+    # Shared pieces of the fused DownBlockUnet / MidBlockUnet pair
+    def __init__(self, trained, control):
+        super().__init__()
+        self.trained = [trained]
+        self.control = [control]
+        self.attn = trained.attn
+        self.cross_attn = trained.cross_attn
+        self.t_emb_dim = trained.t_emb_dim
+        self.num_layers = trained.num_layers
+        self.resnet_conv_first = nn.ModuleList([fuse_norm_act_conv(a, b) for a, b in
+                                                zip(trained.resnet_conv_first, control.resnet_conv_first)])
+        self.resnet_conv_second = nn.ModuleList([fuse_norm_act_conv(a, b) for a, b in
+                                                 zip(trained.resnet_conv_second, control.resnet_conv_second)])
+        self.residual_input_conv = nn.ModuleList([fuse_conv(a, b) for a, b in
+                                                  zip(trained.residual_input_conv, control.residual_input_conv)])
+
+    def _resnet(self, out, i, t_emb_layer, trained_t_emb, control_t_emb):
+        trained, control = self.trained[0], self.control[0]
+        resnet_input = out
+        out = self.resnet_conv_first[i](out)
+        if self.t_emb_dim is not None:
+            emb = torch.cat([trained.t_emb_layers[t_emb_layer](trained_t_emb),
+                             control.t_emb_layers[t_emb_layer](control_t_emb)], dim=1)
+            out = out + emb[:, :, None, None, None]
+        out = self.resnet_conv_second[i](out)
+        return out + self.residual_input_conv[i](resnet_input)
+
+    def _attention(self, out, i, context, trained_kv, control_kv):
+        if not (self.attn or self.cross_attn):
+            return out
+        trained, control = self.trained[0], self.control[0]
+        trained_out, control_out = out.chunk(2, dim=1)
+        if self.attn:
+            trained_out = self_attention(trained.attention_norms[i], trained.attentions[i], trained_out)
+            control_out = self_attention(control.attention_norms[i], control.attentions[i], control_out)
+        if self.cross_attn:
+            trained_out = cross_attention(trained.cross_attention_norms[i], trained.cross_attentions[i],
+                                          trained.context_proj[i], trained_out, context,
+                                          trained_kv[i] if trained_kv is not None else None)
+            control_out = cross_attention(control.cross_attention_norms[i], control.cross_attentions[i],
+                                          control.context_proj[i], control_out, context,
+                                          control_kv[i] if control_kv is not None else None)
+        return torch.cat([trained_out, control_out], dim=1)
+
+
+class FusedDownBlock(FusedBlock):
+    def __init__(self, trained, control):
+        super().__init__(trained, control)
+        self.down_sample_conv = fuse_optional_conv(trained.down_sample_conv, control.down_sample_conv)
+
+    def forward(self, out, trained_t_emb, control_t_emb, context, trained_kv=None, control_kv=None):
+        for i in range(self.num_layers):
+            out = self._resnet(out, i, i, trained_t_emb, control_t_emb)
+            out = self._attention(out, i, context, trained_kv, control_kv)
+        return self.down_sample_conv(out)
+
+
+class FusedMidBlock(FusedBlock):
+    def forward(self, out, trained_t_emb, control_t_emb, context, trained_kv=None, control_kv=None):
+        out = self._resnet(out, 0, 0, trained_t_emb, control_t_emb)
+        for i in range(self.num_layers):
+            out = self._attention(out, i, context, trained_kv, control_kv)
+            # MidBlockUnet applies its first time embedding layer to every resnet block
+            out = self._resnet(out, i + 1, 0, trained_t_emb, control_t_emb)
+        return out
+
+
+class FusedControlNetEncoder(nn.Module):
+    # Downblocks and midblocks of both unets of a ControlNet, run as one pass
+    @torch.no_grad()
+    def __init__(self, controlnet):
+        super().__init__()
+        trained, control = controlnet.trained_unet, controlnet.control_unet
+        self.conv_in = fuse_shared_input_conv(trained.conv_in, control.conv_in)
+        self.downs = nn.ModuleList([FusedDownBlock(a, b) for a, b in zip(trained.downs, control.downs)])
+        self.mids = nn.ModuleList([FusedMidBlock(a, b) for a, b in zip(trained.mids, control.mids)])
+        # Shared with (not copied from) the controlnet
+        self.down_zero_convs = [controlnet.control_unet_down_zero_convs]
+        self.mid_zero_convs = [controlnet.control_unet_mid_zero_convs]
+
+    def forward(self, x, trained_t_emb, control_t_emb, context, hint_out,
+                trained_downs_kv, control_downs_kv, trained_mids_kv, control_mids_kv):
+        down_zero_convs, mid_zero_convs = self.down_zero_convs[0], self.mid_zero_convs[0]
+        out = self.conv_in(x)
+        trained_out, control_out = out.chunk(2, dim=1)
+        out = torch.cat([trained_out, control_out + hint_out], dim=1)
+
+        trained_down_outs = []
+        control_down_outs = []
+        for idx, down in enumerate(self.downs):
+            trained_out, control_out = out.chunk(2, dim=1)
+            trained_down_outs.append(trained_out)
+            control_down_outs.append(down_zero_convs[idx](control_out))
+            out = down(out, trained_t_emb, control_t_emb, context, trained_downs_kv[idx], control_downs_kv[idx])
+
+        for idx, mid in enumerate(self.mids):
+            out = mid(out, trained_t_emb, control_t_emb, context, trained_mids_kv[idx], control_mids_kv[idx])
+            trained_out, control_out = out.chunk(2, dim=1)
+            trained_out = trained_out + mid_zero_convs[idx](control_out)
+            out = torch.cat([trained_out, control_out], dim=1)
+
+        trained_out, _ = out.chunk(2, dim=1)
+        return trained_out, trained_down_outs, control_down_outs
@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DTYPES = {
+    'float32': torch.float32,
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+}
+
+
+class Float32GroupNorm(nn.GroupNorm):
+    # GroupNorm statistics over the large 3D feature maps lose too much in bf16,
+    # so this one always normalises in fp32, even inside an autocast region
+    @staticmethod
+    def from_group_norm(norm):
+        fp32_norm = Float32GroupNorm(norm.num_groups, norm.num_channels, eps=norm.eps, affine=norm.affine)
+        if norm.affine:
+            # Share the parameters so state dicts are unchanged
+            fp32_norm.weight = norm.weight
+            fp32_norm.bias = norm.bias
+        return fp32_norm
+
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            weight = self.weight.float() if self.weight is not None else None
+            bias = self.bias.float() if self.bias is not None else None
+            return F.group_norm(x.float(), self.num_groups, weight, bias, self.eps)
+
+
+def keep_group_norm_fp32(module):
+    for name, child in module.named_children():
+        if type(child) is nn.GroupNorm:
+            setattr(module, name, Float32GroupNorm.from_group_norm(child))
+        else:
+            keep_group_norm_fp32(child)
+
+
+def to_channels_last(x):
+    if torch.is_tensor(x) and x.dim() == 5:
+        return x.contiguous(memory_format=torch.channels_last_3d)
+    return x
+
+
+# Runs a model call under autocast with channels_last_3d inputs and hands back a
+# contiguous fp32 result, so the sampler update and everything after it stays in fp32
+class AutocastCall:
+    def __init__(self, fn, device_type, dtype=torch.bfloat16, channels_last=True):
+        self.fn = fn
+        self.device_type = device_type
+        self.dtype = dtype
+        self.channels_last = channels_last
+
+    def __getattr__(self, name):
+        # Expose attributes of the wrapped callable (e.g. the compiled batch sizes)
+        return getattr(self.fn, name)
+
+    def __call__(self, *args, **kwargs):
+        if self.channels_last:
+            args = tuple(to_channels_last(a) for a in args)
+        with torch.autocast(device_type=self.device_type, dtype=self.dtype,
+                            enabled=self.dtype != torch.float32):
+            out = self.fn(*args, **kwargs)
+        return out.float().contiguous()
+
+
+def prepare_mixed_precision(module, channels_last=True):
+    # In place: fp32 GroupNorm, and channels_last_3d conv weights
+    keep_group_norm_fp32(module)
+    if channels_last:
+        module.to(memory_format=torch.channels_last_3d)
+    return module
@@ -0,0 +1,207 @@
+import functools
+import json
+import os
+import threading
+import time
+import torch
+from torch import nn
+from models.blocks import Attention, WindowAttention
+
+
+def output_bytes(out):
+    if torch.is_tensor(out):
+        return out.numel() * out.element_size()
+    if isinstance(out, (tuple, list)):
+        return sum(output_bytes(o) for o in out)
+    if isinstance(out, dict):
+        return sum(output_bytes(o) for o in out.values())
+    return 0
+
+
+# Analytic FLOPs (2 x multiply-adds) of one call, from the module and its inputs / output.
+# Only leaf compute is counted, so a block's FLOPs are the sum of its children's
+
+def conv_flops(module, inputs, output):
+    kernel = 1
+    for size in module.kernel_size:
+        kernel *= size
+    return 2 * output.numel() * (module.in_channels // module.groups) * kernel
+
+
+def linear_flops(module, inputs, output):
+    return 2 * output.numel() * module.in_features
+
+
+def attention_flops(module, inputs, output):
+    # q/k/v input projections and QK^T, AV. out_proj is an nn.Linear and counted on its own
+    query, key = inputs[0], inputs[1]
+    batch_size, num_queries, channels = query.shape
+    num_keys = key.shape[1]
+    projections = 2 * batch_size * channels * channels * (num_queries + 2 * num_keys)
+    return projections + 2 * 2 * batch_size * num_queries * num_keys * channels
+
+
+def window_attention_flops(module, x, spatial_shape):
+    # Same as attention_flops over the padded volume, every voxel attending within its window
+    batch_size, _, channels = x.shape
+    window_size, _ = module._windows(spatial_shape)
+    tokens, window_tokens = batch_size, 1
+    for size, window in zip(spatial_shape, window_size):
+        tokens *= -(-size // window) * window
+        window_tokens *= window
+    return 2 * 3 * tokens * channels * channels + 2 * 2 * tokens * window_tokens * channels
+
+
+FLOP_COUNTERS = ((nn.Conv3d, conv_flops), (nn.Linear, linear_flops), (Attention, attention_flops))
+
+
+def module_kind(name, module):
+    # Row label of the per-kind rollup, zero convs are plain Conv3d but reported separately
+    if 'zero_conv' in name:
+        return 'ZeroConv3d'
+    return type(module).__name__
+
+
+# Opt-in forward-hook instrumentation. While active, every module of the given roots records
+# call count, inclusive and self (children excluded) wall time, output bytes and analytic FLOPs,
+# and every call becomes a Chrome trace event. Nothing is registered outside the `with` block,
+# so a worker that never profiles pays nothing. Only calls from the thread that started the
+# profiler are recorded, so concurrent jobs on other threads (and tiled decode worker threads)
+# stay out of the report. A torch.compile'd denoiser has no module boundaries to hook.
+class ModuleProfiler:
+    def __init__(self, roots, max_events=500000):
+        # roots: {name: nn.Module}, e.g. the controlnet and the vqvae
+        self.roots = roots
+        self.max_events = max_events
+        self.stats = {}
+        self.events = []
+        self._handles = []
+        self._patched = []
+        self._stack = []
+        self._thread = None
+        self._origin = None
+        self._sync = False
+
+    def start(self):
+        self._thread = threading.get_ident()
+        self._origin = time.perf_counter()
+        self._sync = any(p.is_cuda for root in self.roots.values() for p in root.parameters())
+        for root_name, root in self.roots.items():
+            for name, module in root.named_modules():
+                name = f'{root_name}.{name}' if name else root_name
+                self._handles.append(module.register_forward_pre_hook(functools.partial(self._enter, name)))
+                self._handles.append(module.register_forward_hook(functools.partial(self._exit, name)))
+                if isinstance(module, WindowAttention):
+                    # Windowed self-attention never goes through forward()
+                    module.self_attend = self._wrap_self_attend(name, module)
+                    self._patched.append(module)
+        return self
+
+    def stop(self):
+        for handle in self._handles:
+            handle.remove()
+        for module in self._patched:
+            del module.self_attend
+        self._handles, self._patched, self._stack = [], [], []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _wrap_self_attend(self, name, module):
+        self_attend = module.self_attend
+
+        def wrapped(x, spatial_shape):
+            self._enter(name, module, (x,))
+            out = self_attend(x, spatial_shape)
+            self._exit(name, module, (x,), out, flops=window_attention_flops(module, x, spatial_shape))
+            return out
+        return wrapped
+
+    def _now(self):
+        if self._sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _enter(self, name, module, inputs):
+        if threading.get_ident() != self._thread:
+            return
+        # [name, start, time spent in children, FLOPs of children]
+        self._stack.append([name, self._now(), 0., 0])
+
+    def _exit(self, name, module, inputs, output, flops=None):
+        if threading.get_ident() != self._thread:
+            return
+        end = self._now()
+        # Frames of calls that raised never got their exit hook
+        while self._stack and self._stack[-1][0] != name:
+            self._stack.pop()
+        if not self._stack:
+            return
+        _, start, child_time, child_flops = self._stack.pop()
+        if flops is None:
+            flops = next((counter(module, inputs, output) for cls, counter in FLOP_COUNTERS
+                          if isinstance(module, cls)), 0)
+        duration = end - start
+        total_flops = flops + child_flops
+
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = {'kind': module_kind(name, module), 'calls': 0, 'time_s': 0.,
+                                        'self_s': 0., 'bytes': 0, 'flops': 0}
+        stats['calls'] += 1
+        stats['time_s'] += duration
+        stats['self_s'] += duration - child_time
+        stats['bytes'] += output_bytes(output)
+        stats['flops'] += total_flops
+        if self._stack:
+            self._stack[-1][2] += duration
+            self._stack[-1][3] += total_flops
+
+        if len(self.events) < self.max_events:
+            self.events.append({'name': name, 'cat': stats['kind'], 'ph': 'X',
+                                'ts': (start - self._origin) * 1e6, 'dur': duration * 1e6,
+                                'pid': os.getpid(), 'tid': self._thread,
+                                'args': {'flops': total_flops}})
+
+    def rollup(self):
+        # Self time and leaf FLOPs summed per module kind
+        kinds = {}
+        for stats in self.stats.values():
+            row = kinds.setdefault(stats['kind'], {'calls': 0, 'self_s': 0., 'bytes': 0})
+            row['calls'] += stats['calls']
+            row['self_s'] += stats['self_s']
+            row['bytes'] += stats['bytes']
+        return kinds
+
+    def table(self, top=25):
+        # Modules ranked by inclusive time, then the per-kind rollup ranked by self time
+        total = sum(self.stats[name]['time_s'] for name in self.roots if name in self.stats) or 1.
+        lines = [f"{'module':60s} {'kind':18s} {'calls':>7s} {'total ms':>10s} {'self ms':>10s} "
+                 f"{'%':>6s} {'GFLOP':>9s} {'GFLOP/s':>9s} {'MB out':>9s}"]
+        ranked = sorted(self.stats.items(), key=lambda item: item[1]['time_s'], reverse=True)
+        for name, stats in ranked[:top]:
+            lines.append(f"{name[-60:]:60s} {stats['kind'][:18]:18s} {stats['calls']:7d} "
+                         f"{stats['time_s'] * 1e3:10.1f} {stats['self_s'] * 1e3:10.1f} "
+                         f"{100 * stats['time_s'] / total:6.1f} {stats['flops'] / 1e9:9.2f} "
+                         f"{stats['flops'] / 1e9 / max(stats['time_s'], 1e-9):9.1f} {stats['bytes'] / 2 ** 20:9.1f}")
+        lines.append('')
+        lines.append(f"{'kind':18s} {'calls':>7s} {'self ms':>10s} {'%':>6s} {'MB out':>9s}")
+        for kind, row in sorted(self.rollup().items(), key=lambda item: item[1]['self_s'], reverse=True):
+            lines.append(f"{kind[:18]:18s} {row['calls']:7d} {row['self_s'] * 1e3:10.1f} "
+                         f"{100 * row['self_s'] / total:6.1f} {row['bytes'] / 2 ** 20:9.1f}")
+        return '\n'.join(lines)
+
+    def save(self, output_dir, tag, top=25):
+        # <tag>.txt ranked table, <tag>.json raw per-module stats, <tag>.trace.json for chrome://tracing / Perfetto
+        os.makedirs(output_dir, exist_ok=True)
+        base = os.path.join(output_dir, str(tag))
+        with open(f'{base}.txt', 'w') as f:
+            f.write(self.table(top) + '\n')
+        with open(f'{base}.json', 'w') as f:
+            json.dump(self.stats, f, indent=2)
+        with open(f'{base}.trace.json', 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        return f'{base}.trace.json'
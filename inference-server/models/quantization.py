@@ -0,0 +1,73 @@
+import warnings
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+# First / last layers stay in fp32, they carry most of the quantization error for the least compute
+CONTROLNET_SKIP = ('trained_unet.conv_out',)
+# Only the decoder half of the VQVAE runs at inference time
+VQVAE_INCLUDE = ('post_quant_conv', 'decoder_')
+VQVAE_SKIP = ('decoder_conv_out',)
+
+
+class QuantizedConv(nn.Module):
+    # Static int8 conv with its own quant / dequant boundary, so the fp32 ops around it
+    # (GroupNorm, SiLU, attention, residual adds) are left untouched
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _wrap_convs(module, qconfig, include, skip, prefix=''):
+    for name, child in module.named_children():
+        full_name = prefix + name
+        if type(child) is nn.Conv3d:
+            if full_name.startswith(include) and full_name not in skip:
+                wrapper = QuantizedConv(child)
+                wrapper.qconfig = qconfig
+                setattr(module, name, wrapper)
+        else:
+            _wrap_convs(child, qconfig, include, skip, full_name + '.')
+
+
+def prepare_quantization(controlnet, vqvae, backend='fbgemm'):
+    # Inserts observers in front of / behind every Conv3d that will be quantized
+    torch.backends.quantized.engine = backend
+    qconfig = tq.get_default_qconfig(backend)
+    _wrap_convs(controlnet, qconfig, include='', skip=CONTROLNET_SKIP)
+    _wrap_convs(vqvae, qconfig, include=VQVAE_INCLUDE, skip=VQVAE_SKIP)
+    tq.prepare(controlnet, inplace=True)
+    tq.prepare(vqvae, inplace=True)
+
+
+def convert_quantization(controlnet, vqvae):
+    # Observed convs -> int8 convs, and every nn.Linear (time embedding, context projections)
+    # -> dynamically quantized int8 Linear
+    tq.convert(controlnet, inplace=True)
+    tq.convert(vqvae, inplace=True)
+    tq.quantize_dynamic(controlnet, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    tq.quantize_dynamic(vqvae, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@torch.no_grad()
+def quantize_models(controlnet, vqvae, calibrate_fn, backend='fbgemm'):
+    # calibrate_fn runs representative inputs through both models to fill the observers
+    prepare_quantization(controlnet, vqvae, backend)
+    calibrate_fn()
+    convert_quantization(controlnet, vqvae)
+
+
+def load_quantized(controlnet, vqvae, controlnet_state_dict, vqvae_state_dict, backend='fbgemm'):
+    # Rebuild the int8 module structure on fp32 skeletons, then load the saved scales and weights
+    with warnings.catch_warnings():
+        # observers without calibration data warn when converted, the loaded state replaces them
+        warnings.simplefilter('ignore')
+        prepare_quantization(controlnet, vqvae, backend)
+        convert_quantization(controlnet, vqvae)
+    controlnet.load_state_dict(controlnet_state_dict)
+    vqvae.load_state_dict(vqvae_state_dict)
@@ -0,0 +1,114 @@
+import math
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+def tile_starts(size, tile, overlap):
+    # Tile origins along one axis, the last tile is aligned to the end of the volume
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def blend_ramp(length, window):
+    # Weights rising from ~0 to ~1 over the overlap, so two overlapping tiles blend to a constant
+    positions = (torch.arange(length, dtype=torch.float32) + 0.5) / length
+    if window == 'linear':
+        return positions
+    if window == 'cosine':
+        return 0.5 - 0.5 * torch.cos(math.pi * positions)
+    raise ValueError(f"Unknown blend window '{window}', expected 'linear' or 'cosine'")
+
+
+def axis_weight(start, end, size, ramp_length, window):
+    weight = torch.ones(end - start)
+    ramp_length = min(ramp_length, end - start)
+    if ramp_length > 0 and start > 0:
+        weight[:ramp_length] = blend_ramp(ramp_length, window)
+    if ramp_length > 0 and end < size:
+        weight[-ramp_length:] = torch.minimum(weight[-ramp_length:], blend_ramp(ramp_length, window).flip(0))
+    return weight
+
+
+# Decodes a latent as overlapping 3D tiles and blends the seams, so peak decoder memory is bounded
+# by the tile rather than the volume. The decoder's GroupNorms see tile statistics, so the result
+# is close to, not identical with, the monolithic decode (tools/check_tiled_decode.py)
+class TiledDecoder:
+    def __init__(self, decode_fn, scale_factor, tile_size=(16, 16, 16), overlap=4, window='cosine', num_workers=1):
+        self.decode_fn = decode_fn
+        self.scale_factor = scale_factor
+        self.tile_size = tuple(tile_size) if isinstance(tile_size, (list, tuple)) else (tile_size,) * 3
+        self.overlap = overlap
+        self.window = window
+        self.num_workers = num_workers
+        # Checked here so a bad config fails at startup rather than on the first job's decode
+        if not 0 <= overlap < min(self.tile_size):
+            raise ValueError(f"tiled decode overlap must be in [0, {min(self.tile_size)}) for tiles of "
+                             f"{self.tile_size}, got {overlap}")
+        blend_ramp(1, window)
+
+    def tiles(self, spatial_shape):
+        starts = [tile_starts(size, min(tile, size), self.overlap)
+                  for size, tile in zip(spatial_shape, self.tile_size)]
+        return [(d, h, w) for d in starts[0] for h in starts[1] for w in starts[2]]
+
+    def _decode_tile(self, z, start):
+        # Grad mode is thread local, so it is switched off again in the worker threads
+        with torch.no_grad():
+            index = tuple(slice(s, s + min(tile, size))
+                          for s, tile, size in zip(start, self.tile_size, z.shape[2:]))
+            return self.decode_fn(z[(slice(None), slice(None)) + index].contiguous())
+
+    def _decode_tiles(self, executor, z, tiles):
+        # Tile outputs in order, with at most num_workers tiles decoding or decoded and not yet
+        # blended, so the thread pool does not undo the memory bound of tiling
+        in_flight = collections.deque()
+        for start in tiles:
+            if len(in_flight) >= self.num_workers:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(self._decode_tile, z, start))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def _weight(self, start, spatial_shape, device):
+        f = self.scale_factor
+        weights = []
+        for s, tile, size in zip(start, self.tile_size, spatial_shape):
+            tile = min(tile, size)
+            weights.append(axis_weight(s * f, (s + tile) * f, size * f, self.overlap * f, self.window))
+        weight = weights[0][:, None, None] * weights[1][None, :, None] * weights[2][None, None, :]
+        return weight.to(device)
+
+    @torch.no_grad()
+    def __call__(self, z):
+        spatial_shape = tuple(z.shape[2:])
+        tiles = self.tiles(spatial_shape)
+        if len(tiles) == 1:
+            return self.decode_fn(z)
+
+        if self.num_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=self.num_workers)
+            outputs = self._decode_tiles(executor, z, tiles)
+        else:
+            executor = None
+            outputs = (self._decode_tile(z, start) for start in tiles)
+
+        f = self.scale_factor
+        out = None
+        total = torch.zeros([size * f for size in spatial_shape], device=z.device)
+        try:
+            for start, tile_out in zip(tiles, outputs):
+                if out is None:
+                    out = torch.zeros((z.size(0), tile_out.size(1), *total.shape),
+                                      dtype=tile_out.dtype, device=z.device)
+                weight = self._weight(start, spatial_shape, z.device)
+                index = tuple(slice(s * f, s * f + size) for s, size in zip(start, tile_out.shape[2:]))
+                out[(slice(None), slice(None)) + index] += tile_out * weight
+                total[index] += weight
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        return out / total
@@ -17,6 +17,9 @@ class UNet(nn.Module):
         self.num_mid_layers = model_config['num_mid_layers']
         self.num_up_layers = model_config['num_up_layers']
         self.attns = model_config['attn_down']
+        # Per level 'global' or 'window' (3D local attention over attn_window sized windows)
+        self.attn_kinds = get_config_value(model_config, 'attn_kind', ['global'] * len(self.attns))
+        self.attn_window = get_config_value(model_config, 'attn_window', 4)
         self.norm_channels = model_config['norm_channels']
         self.num_heads = model_config['num_heads']
         self.conv_out_channels = model_config['conv_out_channels']
@@ -26,6 +29,7 @@ class UNet(nn.Module):
         assert self.mid_channels[-1] == self.down_channels[-2]
         assert len(self.down_sample) == len(self.down_channels) - 1
         assert len(self.attns) == len(self.down_channels) - 1
+        assert len(self.attn_kinds) == len(self.attns)
 
         # Conditioning Config #
         self.context_cond = False
@@ -57,6 +61,8 @@ class UNet(nn.Module):
                                         num_heads=self.num_heads,
                                         num_layers=self.num_down_layers,
                                         attn=self.attns[i],
+                                        attn_kind=self.attn_kinds[i],
+                                        window_size=self.attn_window,
                                         norm_channels=self.norm_channels,
                                         cross_attn=self.attention_levels[i],
                                         context_dim=self.context_embed_dim))
@@ -67,11 +73,15 @@ class UNet(nn.Module):
                                       num_heads=self.num_heads,
                                       num_layers=self.num_mid_layers,
                                       attn=True,
+                                      # the mid blocks run at the coarsest level
+                                      attn_kind=self.attn_kinds[-1],
+                                      window_size=self.attn_window,
                                       norm_channels=self.norm_channels,
                                       cross_attn=self.context_cond,
                                       context_dim=self.context_embed_dim))
 
         attns_up = list(reversed(self.attns))
+        attn_kinds_up = list(reversed(self.attn_kinds))
         self.ups = nn.ModuleList([])
         prev = self.mid_channels[-1]
 
@@ -90,6 +100,8 @@ class UNet(nn.Module):
                         num_heads=self.num_heads,
                         num_layers=self.num_up_layers,
                         attn=attns_up[idx],
+                        attn_kind=attn_kinds_up[idx],
+                        window_size=self.attn_window,
                         norm_channels=self.norm_channels
                     )
                 )
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from models.blocks import DownBlock, MidBlock, UpBlock
+from utils.config_utils import get_config_value
 
 
 class VQVAE(nn.Module):
@@ -15,18 +16,24 @@ class VQVAE(nn.Module):
 
         # To disable attention in Downblock of Encoder and Upblock of Decoder
         self.attns = model_config['attn_down']
+        # Per level 'global' or 'window' (3D local attention over attn_window sized windows)
+        self.attn_kinds = get_config_value(model_config, 'attn_kind', ['global'] * len(self.attns))
+        self.attn_window = get_config_value(model_config, 'attn_window', 4)
 
         # Latent Dimension
         self.z_channels = model_config['z_channels']
         self.codebook_size = model_config['codebook_size']
         self.norm_channels = model_config['norm_channels']
         self.num_heads = model_config['num_heads']
+        # Voxels per nearest-codebook search, bounds the (chunk, codebook_size) distance matrix
+        self.quantize_chunk = get_config_value(model_config, 'quantize_chunk', 4096)
 
         # Assertion to validate the channel information
         assert self.mid_channels[0] == self.down_channels[-1]
         assert self.mid_channels[-1] == self.down_channels[-1]
         assert len(self.down_sample) == len(self.down_channels) - 1
         assert len(self.attns) == len(self.down_channels) - 1
+        assert len(self.attn_kinds) == len(self.attns)
 
         # Wherever we use downsampling in encoder correspondingly use
         # upsampling in decoder
@@ -43,6 +50,8 @@ class VQVAE(nn.Module):
                                                  num_heads=self.num_heads,
                                                  num_layers=self.num_down_layers,
                                                  attn=self.attns[i],
+                                                 attn_kind=self.attn_kinds[i],
+                                                 window_size=self.attn_window,
                                                  norm_channels=self.norm_channels))
 
         self.encoder_mids = nn.ModuleList([])
@@ -52,6 +61,8 @@ class VQVAE(nn.Module):
                                               num_heads=self.num_heads,
                                               num_layers=self.num_mid_layers,
                                               attn=self.attns[i],
+                                              attn_kind=self.attn_kinds[i],
+                                              window_size=self.attn_window,
                                               norm_channels=self.norm_channels))
 
         self.encoder_norm_out = nn.GroupNorm(self.norm_channels, self.down_channels[-1])
@@ -62,6 +73,8 @@ class VQVAE(nn.Module):
 
         # Codebook
         self.embedding = nn.Embedding(self.codebook_size, self.z_channels)
+        # (version, data_ptr, device, dtype) of the codebook and its squared norms
+        self._codebook_norms = (None, None)
         ####################################################
 
         ##################### Decoder ######################
@@ -78,6 +91,8 @@ class VQVAE(nn.Module):
                                               num_heads=self.num_heads,
                                               num_layers=self.num_mid_layers,
                                               attn=self.attns[i - 1],
+                                              attn_kind=self.attn_kinds[i - 1],
+                                              window_size=self.attn_window,
                                               norm_channels=self.norm_channels))
 
         self.decoder_layers = nn.ModuleList([])
@@ -88,32 +103,65 @@ class VQVAE(nn.Module):
                                                num_heads=self.num_heads,
                                                num_layers=self.num_up_layers,
                                                attn=self.attns[i - 1],
+                                               attn_kind=self.attn_kinds[i - 1],
+                                               window_size=self.attn_window,
                                                norm_channels=self.norm_channels))
 
         self.decoder_norm_out = nn.GroupNorm(self.norm_channels, self.down_channels[0])
         self.decoder_conv_out = nn.Conv3d(self.down_channels[0], im_channels, kernel_size=3, padding=1)
 
+    def codebook_norms(self):
+        # ||e||^2 of every codebook vector, recomputed only when the weights change (load_state_dict,
+        # optimizer steps and .to() all bump the version or move the storage)
+        weight = self.embedding.weight
+        # Tensors created under inference_mode have no version counter, the storage has to do
+        version = None if weight.is_inference() else weight._version
+        key = (version, weight.data_ptr(), weight.device, weight.dtype)
+        if self._codebook_norms[0] != key:
+            with torch.no_grad():
+                self._codebook_norms = (key, weight.detach().pow(2).sum(1))
+        return self._codebook_norms[1]
+
+    def nearest_codes(self, x):
+        # (N, C) -> (N,) index of the nearest codebook vector. argmin over k of
+        # ||x||^2 - 2 x.e_k + ||e_k||^2 drops the ||x||^2 term (constant per row), the rest is one
+        # addmm per chunk of voxels, so only a (chunk, K) block of distances exists at a time
+        weight = self.embedding.weight.detach()
+        norms = self.codebook_norms()
+        indices = torch.empty(x.size(0), dtype=torch.long, device=x.device)
+        with torch.no_grad():
+            for start in range(0, x.size(0), self.quantize_chunk):
+                chunk = x[start:start + self.quantize_chunk].detach()
+                dist = torch.addmm(norms, chunk, weight.t(), alpha=-2)
+                torch.argmin(dist, dim=-1, out=indices[start:start + self.quantize_chunk])
+        return indices
+
+    def quantize_indices(self, x):
+        # B, C, D, H, W -> B, D, H, W codebook indices, no losses and no straight-through copy
+        B, C, D, H, W = x.shape
+        x = x.permute(0, 2, 3, 4, 1).reshape(-1, C)
+        return self.nearest_codes(x).reshape(B, D, H, W)
+
+    def lookup(self, indices):
+        # B, D, H, W codebook indices -> B, C, D, H, W quantized latent
+        return self.embedding(indices).permute(0, 4, 1, 2, 3)
+
     def quantize(self, x):
         B, C, D, H, W = x.shape
 
         # B, C, D, H, W -> B, D, H, W, C
         x = x.permute(0, 2, 3, 4, 1)
 
-        # B, H, W, C -> B, H*W, C
-        x = x.reshape(x.size(0), -1, x.size(-1))
+        # B, D, H, W, C -> B*D*H*W, C
+        x = x.reshape((-1, x.size(-1)))
 
-        # Find nearest embedding/codebook vector
-        # dist between (B, H*W, C) and (B, K, C) -> (B, H*W, K)
-        dist = torch.cdist(x, self.embedding.weight[None, :].repeat((x.size(0), 1, 1)))
-        # (B, H*W)
-        min_encoding_indices = torch.argmin(dist, dim=-1)
+        # Find nearest embedding/codebook vector (B*D*H*W,)
+        min_encoding_indices = self.nearest_codes(x)
 
         # Replace encoder output with nearest codebook
-        # quant_out -> B*H*W, C
-        quant_out = torch.index_select(self.embedding.weight, 0, min_encoding_indices.view(-1))
+        # quant_out -> B*D*H*W, C
+        quant_out = torch.index_select(self.embedding.weight, 0, min_encoding_indices)
 
-        # x -> B*H*W, C
-        x = x.reshape((-1, x.size(-1)))
         commmitment_loss = torch.mean((quant_out.detach() - x) ** 2)
         codebook_loss = torch.mean((quant_out - x.detach()) ** 2)
         quantize_losses = {
@@ -128,7 +176,7 @@ class VQVAE(nn.Module):
         min_encoding_indices = min_encoding_indices.reshape((-1, quant_out.size(-2), quant_out.size(-1)))
         return quant_out, quantize_losses, min_encoding_indices
 
-    def encode(self, x):
+    def encode_pre_quant(self, x):
         out = self.encoder_conv_in(x)
         for idx, down in enumerate(self.encoder_layers):
             out = down(out)
@@ -137,10 +185,21 @@ class VQVAE(nn.Module):
         out = self.encoder_norm_out(out)
         out = nn.SiLU()(out)
         out = self.encoder_conv_out(out)
-        out = self.pre_quant_conv(out)
+        return self.pre_quant_conv(out)
+
+    def encode(self, x, return_losses=True):
+        # return_losses=False (inference) skips the losses and the straight-through estimate,
+        # the quantized latent is the same and the losses are returned as None
+        out = self.encode_pre_quant(x)
+        if not return_losses:
+            return self.lookup(self.quantize_indices(out)), None
         out, quant_losses, _ = self.quantize(out)
         return out, quant_losses
 
+    def encode_indices(self, x):
+        # B, D, H, W codebook indices of the encoded input
+        return self.quantize_indices(self.encode_pre_quant(x))
+
     def decode(self, z):
         out = z
         out = self.post_quant_conv(out)
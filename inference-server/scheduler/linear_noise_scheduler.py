@@ -18,33 +18,66 @@ class LinearNoiseScheduler:
         self.sqrt_alpha_cum_prod = torch.sqrt(self.alpha_cum_prod)
         self.sqrt_one_minus_alpha_cum_prod = torch.sqrt(1-self.alpha_cum_prod)
 
+        # Per-step coefficients of the reverse update, computed once in float64
+        betas = self.betas.double()
+        alpha_cum_prod = self.alpha_cum_prod.double()
+        alpha_cum_prod_prev = torch.cat([alpha_cum_prod.new_ones(1), alpha_cum_prod[:-1]])
+        sqrt_one_minus_alpha_cum_prod = torch.sqrt(1 - alpha_cum_prod)
+        sqrt_alphas = torch.sqrt(1 - betas)
+        variance = (1 - alpha_cum_prod_prev) / (1 - alpha_cum_prod) * betas
+        variance[0] = 0.
+        self._coefficients = {
+            'sqrt_alpha_cum_prod': torch.sqrt(alpha_cum_prod),
+            'sqrt_one_minus_alpha_cum_prod': sqrt_one_minus_alpha_cum_prod,
+            # x0 = x0_xt_coef * xt - x0_noise_coef * noise_pred
+            'x0_xt_coef': 1 / torch.sqrt(alpha_cum_prod),
+            'x0_noise_coef': sqrt_one_minus_alpha_cum_prod / torch.sqrt(alpha_cum_prod),
+            # mean = mean_xt_coef * xt - mean_noise_coef * noise_pred
+            'mean_xt_coef': 1 / sqrt_alphas,
+            'mean_noise_coef': betas / (sqrt_one_minus_alpha_cum_prod * sqrt_alphas),
+            'sigma': torch.sqrt(variance),
+        }
+        # Device-resident copies of the coefficient tables, keyed by (device, dtype)
+        self._tables = {}
+
+    def tables(self, device, dtype=torch.float32):
+        key = (torch.device(device), dtype)
+        tables = self._tables.get(key)
+        if tables is None:
+            tables = {name: values.to(device=device, dtype=dtype)
+                      for name, values in self._coefficients.items()}
+            self._tables[key] = tables
+        return tables
+
+    def _at(self, name, t, x):
+        # Gather per-step coefficients for a scalar t, or a per-sample timestep vector
+        # reshaped to broadcast against x
+        values = self.tables(x.device, x.dtype)[name][t]
+        if values.dim() > 0:
+            values = values.reshape(-1, *([1] * (x.dim() - 1)))
+        return values
+
     # forward process
     def add_noise(self, original, noise, t):
-        original_shape = original.shape
-        batch_size = original_shape[0]
-
-        sqrt_alpha_cum_prod = self.sqrt_alpha_cum_prod.to(original.device)[t].reshape(batch_size)
-        sqrt_one_minus_alpha_cum_prod = self.sqrt_one_minus_alpha_cum_prod.to(original.device)[t].reshape(batch_size)
+        t = torch.as_tensor(t).to(original.device).reshape(original.shape[0])
 
-        for _ in range(len(original_shape)-1):
-            sqrt_alpha_cum_prod = sqrt_alpha_cum_prod.unsqueeze(-1)
-            sqrt_one_minus_alpha_cum_prod = sqrt_one_minus_alpha_cum_prod.unsqueeze(-1)
+        sqrt_alpha_cum_prod = self._at('sqrt_alpha_cum_prod', t, original)
+        sqrt_one_minus_alpha_cum_prod = self._at('sqrt_one_minus_alpha_cum_prod', t, original)
 
         return sqrt_alpha_cum_prod*original + sqrt_one_minus_alpha_cum_prod*noise
 
     # reverse process
-    def sample_prev_timestep(self, xt, noise_pred, t):
-        x0 = (xt - (self.sqrt_one_minus_alpha_cum_prod.to(xt.device)[t] * noise_pred)) / self.sqrt_alpha_cum_prod.to(xt.device)[t]
+    def sample_prev_timestep(self, xt, noise_pred, t, generator=None):
+        t = torch.as_tensor(t).to(xt.device)
+        x0 = self._at('x0_xt_coef', t, xt) * xt - self._at('x0_noise_coef', t, xt) * noise_pred
         x0 = torch.clamp(x0, -1., 1.)
 
-        mean = xt - ((self.betas.to(xt.device)[t] * noise_pred) / (self.sqrt_one_minus_alpha_cum_prod.to(xt.device)[t]))
-        mean = mean / torch.sqrt(self.alphas.to(xt.device)[t])
+        mean = self._at('mean_xt_coef', t, xt) * xt - self._at('mean_noise_coef', t, xt) * noise_pred
 
-        if t == 0:
+        if t.dim() == 0 and t == 0:
             return mean, x0
         else:
-            variance = (1 - self.alpha_cum_prod.to(xt.device)[t-1]) / (1. - self.alpha_cum_prod.to(xt.device)[t])
-            variance = variance * self.betas.to(xt.device)[t]
-            sigma = variance ** 0.5
-            z = torch.randn(xt.shape).to(xt.device)
-            return mean + sigma*z, x0
\ No newline at end of file
+            # sigma is zero at t = 0, so samples that already reached it take the mean
+            sigma = self._at('sigma', t, xt)
+            z = torch.randn(xt.shape, generator=generator, device=xt.device, dtype=xt.dtype)
+            return mean + sigma*z, x0
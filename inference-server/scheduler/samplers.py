@@ -0,0 +1,152 @@
+import math
+import torch
+
+
+def get_sampling_timesteps(num_timesteps, num_steps):
+    # Evenly spaced sub-sequence of the trained schedule, always ending at t = 0
+    if num_steps is None or num_steps >= num_timesteps:
+        return list(reversed(range(num_timesteps)))
+    assert num_steps > 0, "num_steps must be positive"
+    if num_steps == 1:
+        return [num_timesteps - 1]
+    steps = {int(round(i * (num_timesteps - 1) / (num_steps - 1))) for i in range(num_steps)}
+    return sorted(steps, reverse=True)
+
+
+class DDPMSampler:
+    # Ancestral sampling over every trained timestep (LinearNoiseScheduler.sample_prev_timestep),
+    # num_steps cannot shorten it
+    def __init__(self, scheduler, num_steps=None, eta=1., generator=None):
+        self.scheduler = scheduler
+        self.generator = generator
+        self.timesteps = list(reversed(range(scheduler.num_timesteps)))
+        if num_steps is not None and num_steps != len(self.timesteps):
+            print(f"[ERROR] ddpm runs all {len(self.timesteps)} trained timesteps, ignoring num_steps={num_steps} "
+                  f"(use 'ddim', 'dpm_solver' or 'euler' for fewer steps)")
+
+    def reset(self):
+        pass
+
+    def step(self, xt, noise_pred, i):
+        t = self.timesteps[i]
+        return self.scheduler.sample_prev_timestep(xt, noise_pred, t, generator=self.generator)
+
+
+class DDIMSampler:
+    # DDIM (Song et al.) over a sub-sequence of the trained schedule, eta = 0 is deterministic
+    def __init__(self, scheduler, num_steps=50, eta=0., generator=None):
+        self.scheduler = scheduler
+        self.eta = eta
+        self.generator = generator
+        self.timesteps = get_sampling_timesteps(scheduler.num_timesteps, num_steps)
+        self.alpha_cum_prod = scheduler.alpha_cum_prod.tolist()
+
+    def reset(self):
+        pass
+
+    def _alpha_cum_prod(self, t):
+        return self.alpha_cum_prod[t] if t >= 0 else 1.
+
+    def _prev_timestep(self, i):
+        return self.timesteps[i + 1] if i + 1 < len(self.timesteps) else -1
+
+    def step(self, xt, noise_pred, i):
+        t = self.timesteps[i]
+        alpha_t = self._alpha_cum_prod(t)
+        alpha_prev = self._alpha_cum_prod(self._prev_timestep(i))
+
+        x0 = (xt - math.sqrt(1 - alpha_t) * noise_pred) / math.sqrt(alpha_t)
+
+        sigma = self.eta * math.sqrt((1 - alpha_prev) / (1 - alpha_t)) * math.sqrt(1 - alpha_t / alpha_prev)
+        direction = math.sqrt(max(1 - alpha_prev - sigma ** 2, 0.)) * noise_pred
+        x_prev = math.sqrt(alpha_prev) * x0 + direction
+        if sigma > 0:
+            z = torch.randn(xt.shape, generator=self.generator, device=xt.device, dtype=xt.dtype)
+            x_prev = x_prev + sigma * z
+        return x_prev, torch.clamp(x0, -1., 1.)
+
+
+class DPMSolverSampler(DDIMSampler):
+    # DPM-Solver++(2M) in data prediction form, first order on the first and last step
+    def __init__(self, scheduler, num_steps=25, eta=0., generator=None):
+        super().__init__(scheduler, num_steps=num_steps, eta=0., generator=generator)
+        self.reset()
+
+    def reset(self):
+        self.prev_x0 = None
+        self.prev_lambda = None
+
+    def _lambda(self, alpha):
+        # log(alpha_t / sigma_t)
+        return 0.5 * math.log(alpha) - 0.5 * math.log(1 - alpha)
+
+    def step(self, xt, noise_pred, i):
+        t = self.timesteps[i]
+        t_prev = self._prev_timestep(i)
+        alpha_t = self._alpha_cum_prod(t)
+        x0 = (xt - math.sqrt(1 - alpha_t) * noise_pred) / math.sqrt(alpha_t)
+
+        if t_prev < 0:
+            # sigma reaches zero, the sample is the data prediction itself
+            self.reset()
+            return x0, torch.clamp(x0, -1., 1.)
+
+        alpha_prev = self._alpha_cum_prod(t_prev)
+        lambda_t = self._lambda(alpha_t)
+        lambda_prev = self._lambda(alpha_prev)
+        h = lambda_prev - lambda_t
+
+        denoised = x0
+        if self.prev_x0 is not None:
+            r = (lambda_t - self.prev_lambda) / h
+            denoised = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * self.prev_x0
+
+        x_prev = (math.sqrt(1 - alpha_prev) / math.sqrt(1 - alpha_t)) * xt \
+            - math.sqrt(alpha_prev) * math.expm1(-h) * denoised
+
+        self.prev_x0 = x0
+        self.prev_lambda = lambda_t
+        return x_prev, torch.clamp(x0, -1., 1.)
+
+
+class EulerSampler(DDIMSampler):
+    # Euler (ancestral when eta > 0) in the variance exploding parameterisation x / sqrt(alpha_cum_prod)
+    def _sigma(self, alpha):
+        return math.sqrt((1 - alpha) / alpha)
+
+    def step(self, xt, noise_pred, i):
+        t = self.timesteps[i]
+        alpha_t = self._alpha_cum_prod(t)
+        alpha_prev = self._alpha_cum_prod(self._prev_timestep(i))
+        sigma = self._sigma(alpha_t)
+        sigma_next = self._sigma(alpha_prev)
+
+        x0 = (xt - math.sqrt(1 - alpha_t) * noise_pred) / math.sqrt(alpha_t)
+
+        sigma_up = 0.
+        if self.eta > 0 and sigma_next > 0:
+            sigma_up = min(sigma_next,
+                           self.eta * math.sqrt(sigma_next ** 2 * (sigma ** 2 - sigma_next ** 2) / sigma ** 2))
+        sigma_down = math.sqrt(sigma_next ** 2 - sigma_up ** 2)
+
+        x = xt / math.sqrt(alpha_t)
+        x = x + (sigma_down - sigma) * noise_pred
+        if sigma_up > 0:
+            z = torch.randn(xt.shape, generator=self.generator, device=xt.device, dtype=xt.dtype)
+            x = x + sigma_up * z
+        return x * math.sqrt(alpha_prev), torch.clamp(x0, -1., 1.)
+
+
+SAMPLERS = {
+    'ddpm': DDPMSampler,
+    'ddim': DDIMSampler,
+    'dpm_solver': DPMSolverSampler,
+    'euler': EulerSampler,
+}
+
+
+def get_sampler(scheduler, name='ddpm', num_steps=None, eta=0., generator=None):
+    assert name in SAMPLERS, f"Unknown sampler '{name}', expected one of {list(SAMPLERS)}"
+    if num_steps is None:
+        return SAMPLERS[name](scheduler, eta=eta, generator=generator)
+    return SAMPLERS[name](scheduler, num_steps=num_steps, eta=eta, generator=generator)
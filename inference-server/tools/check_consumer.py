@@ -0,0 +1,114 @@
+import argparse
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from worker.consumer import AckingConsumer
+
+# In-process stand-in for a pika BlockingConnection / channel: delivers at most prefetch_count
+# unacked messages, runs threadsafe callbacks and "heartbeats" on the consuming (I/O) thread,
+# and records acks / nacks, so AckingConsumer can be checked without a broker.
+
+
+class StandInConnection:
+    def __init__(self):
+        self.callbacks = queue.Queue()
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+
+class StandInChannel:
+    def __init__(self, connection, bodies):
+        self.connection = connection
+        self.pending = list(bodies)
+        self.prefetch = None
+        self.on_message = None
+        self.unacked = set()
+        self.acked, self.nacked = [], []
+        self.max_unacked = 0
+        self.heartbeats = 0
+        self.max_heartbeat_gap = 0.
+        self.io_thread = None
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        assert not auto_ack, 'consumer must ack manually'
+        self.on_message = on_message_callback
+
+    def _settle(self, delivery_tag):
+        assert threading.current_thread() is self.io_thread, 'channel used off the I/O thread'
+        self.unacked.remove(delivery_tag)
+
+    def basic_ack(self, delivery_tag):
+        self._settle(delivery_tag)
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self._settle(delivery_tag)
+        self.nacked.append((delivery_tag, requeue))
+
+    def start_consuming(self):
+        self.io_thread = threading.current_thread()
+        tag = 0
+        last_beat = time.monotonic()
+        while self.pending or self.unacked:
+            while self.pending and len(self.unacked) < self.prefetch:
+                tag += 1
+                self.unacked.add(tag)
+                self.max_unacked = max(self.max_unacked, len(self.unacked))
+                self.on_message(self, SimpleNamespace(delivery_tag=tag), None, self.pending.pop(0))
+            try:
+                self.connection.callbacks.get(timeout=0.01)()
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            self.max_heartbeat_gap = max(self.max_heartbeat_gap, now - last_beat)
+            self.heartbeats += 1
+            last_beat = now
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check manual acks / prefetch of the consumer against a stand-in broker')
+    parser.add_argument('--num_messages', type=int, default=12)
+    parser.add_argument('--prefetch', type=int, default=3)
+    parser.add_argument('--job_seconds', type=float, default=0.2)
+    args = parser.parse_args()
+
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def handle(body):
+        # Every third message fails, the rest "upload" after job_seconds of work
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(args.job_seconds)
+        with lock:
+            running['now'] -= 1
+        if int(body) % 3 == 2:
+            raise RuntimeError('simulated inference failure')
+        return True
+
+    connection = StandInConnection()
+    channel = StandInChannel(connection, [str(i).encode() for i in range(args.num_messages)])
+    consumer = AckingConsumer(connection, channel, 'mriPredictionQueue', handle, prefetch=args.prefetch)
+    start = time.perf_counter()
+    consumer.start()
+    elapsed = time.perf_counter() - start
+
+    expected_failures = sum(1 for i in range(args.num_messages) if i % 3 == 2)
+    assert len(channel.acked) == args.num_messages - expected_failures, channel.acked
+    assert len(channel.nacked) == expected_failures and all(not r for _, r in channel.nacked), channel.nacked
+    assert channel.max_unacked <= args.prefetch, channel.max_unacked
+    assert running['max'] == args.prefetch, running['max']
+    assert channel.max_heartbeat_gap < args.job_seconds, 'I/O thread was blocked by a job'
+    print(f"{args.num_messages} messages in {elapsed:.2f}s: {len(channel.acked)} acked, "
+          f"{len(channel.nacked)} rejected, {running['max']} concurrent jobs (prefetch {args.prefetch}), "
+          f"longest I/O loop gap {channel.max_heartbeat_gap * 1e3:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from worker.http_io import HttpClient, read_volume
+
+# Local stand-in for the backend: serves /uploads/<name>, accepts the multipart result upload,
+# and answers the first request of each kind with a 503 to exercise the retries. /mri/check/error
+# always answers 500, which an upload must not retry (the backend may have completed the job)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _should_fail(self, kind):
+        state = self.server.state
+        with state['lock']:
+            state['connections'].add(self.client_address)
+            state['requests'][kind] = state['requests'].get(kind, 0) + 1
+            return state['requests'][kind] <= state['fail_first']
+
+    def do_GET(self):
+        if self._should_fail('get'):
+            return self._reply(503)
+        name = self.path.split('?')[0][len('/uploads/'):]
+        data = self.server.state['files'].get(name)
+        if data is None:
+            return self._reply(404)
+        self._reply(200, data)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        if self.path.startswith('/mri/check/error'):
+            with self.server.state['lock']:
+                self.server.state['requests']['post_error'] = self.server.state['requests'].get('post_error', 0) + 1
+            return self._reply(500)
+        if self._should_fail('post'):
+            return self._reply(503)
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        part = body.split(b'--' + boundary)[1]
+        # Drop the part headers and the CRLF in front of the next boundary
+        self.server.state['uploads'].append(part.split(b'\r\n\r\n', 1)[1][:-2])
+        self._reply(200, b'ok')
+
+
+def start_server(files, fail_first):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.state = {'files': files, 'fail_first': fail_first, 'requests': {}, 'uploads': [],
+                    'connections': set(), 'lock': threading.Lock()}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the streaming / pooled HTTP client against a local stand-in')
+    parser.add_argument('--num_jobs', type=int, default=5)
+    parser.add_argument('--fail_first', type=int, default=1,
+                        help='503 responses before the stand-in starts answering each request kind')
+    args = parser.parse_args()
+
+    latent = np.random.default_rng(0).standard_normal((32, 32, 40, 32)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        latent_path = os.path.join(tmp, 'latent.npy')
+        np.save(latent_path, latent)
+        with open(latent_path, 'rb') as f:
+            files = {'latent.npy': f.read()}
+
+        server = start_server(files, args.fail_first)
+        base_url = f'http://127.0.0.1:{server.server_address[1]}'
+        client = HttpClient(retries=max(3, args.fail_first), backoff=0.01, chunk_size=1 << 16)
+        try:
+            for idx in range(args.num_jobs):
+                save_path = client.download(f'{base_url}/uploads/latent.npy', os.path.join(tmp, f'in_{idx}.npy'))
+                assert np.array_equal(np.load(save_path), latent), 'streamed download differs'
+
+                array, affine = read_volume(client.fetch(f'{base_url}/uploads/latent.npy'))
+                assert np.array_equal(array, latent) and np.array_equal(affine, np.eye(4)), \
+                    'in-memory download differs'
+
+                response = client.upload_file(f'{base_url}/mri/check/complete', latent_path,
+                                              params={'mriImageId': idx, 'mriResultId': idx})
+                assert response.status_code == 200, f'upload failed with {response.status_code}'
+                assert server.state['uploads'][-1] == files['latent.npy'], 'uploaded body differs'
+
+            response = client.upload_file(f'{base_url}/mri/check/error', latent_path)
+            assert response.status_code == 500 and server.state['requests']['post_error'] == 1, \
+                'upload was re-sent after a 500'
+        finally:
+            client.close()
+            server.shutdown()
+
+    state = server.state
+    print(f"requests: {state['requests']} (first {args.fail_first} of each kind answered 503)")
+    print(f"TCP connections used: {len(state['connections'])} for {args.num_jobs * 3} transfers")
+    print('All downloads and uploads match, a 500 on upload was not retried')
+
+
+if __name__ == '__main__':
+    main()
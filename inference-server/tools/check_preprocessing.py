@@ -0,0 +1,79 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from models import const
+from worker.preprocessing import Preprocessor, MonaiPreprocessor
+
+
+def rotation_z(degrees):
+    angle = np.deg2rad(degrees)
+    rotation = np.eye(4)
+    rotation[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    return rotation
+
+
+def cases(tmp_dir, rng):
+    # (name, source) covering the resample, skip-resample, crop and pad paths
+    latent = rng.standard_normal(const.LATENT_SHAPE_DM).astype(np.float32)
+    npy_path = os.path.join(tmp_dir, 'latent.npy')
+    np.save(npy_path, latent)
+    conforming = np.diag([const.RESOLUTION] * 3 + [1.])
+    conforming[:3, 3] = [-20., 12., 3.]
+    flipped = np.diag([-1., 1., 1.2, 1.])
+    flipped[:3, 3] = [30., -10., 0.]
+    big = rng.standard_normal((4, 50, 61, 47)).astype(np.float32)
+    return [
+        ('npy file (1mm identity affine)', npy_path),
+        ('in memory, identity affine', (latent, np.eye(4))),
+        ('in memory, already at RESOLUTION', (latent, conforming)),
+        ('in memory, flipped / anisotropic', (latent, flipped)),
+        ('in memory, rotated', (latent, rotation_z(10.) @ np.diag([1.2, 1.2, 1.2, 1.]))),
+        ('in memory, larger than the crop', (big, conforming)),
+    ]
+
+
+def timed(fn, repeats):
+    out = fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parity and speed of the lean preprocessing vs the MONAI Compose')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    covariates = (1, 0.5, 0.72, 0.81)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        all_cases = cases(tmp_dir, rng)
+
+        lean = Preprocessor(args.device)
+        lean_out = [timed(lambda: lean(source, *covariates), args.repeats) for _, source in all_cases]
+        # The lean path must not pull MONAI in
+        assert 'monai' not in sys.modules, 'lean preprocessing imported monai'
+
+        monai = MonaiPreprocessor(args.device)
+        failed = False
+        for (name, source), ((context, hint), lean_s) in zip(all_cases, lean_out):
+            (ref_context, ref_hint), monai_s = timed(lambda: monai(source, *covariates), args.repeats)
+            ok = hint.shape == ref_hint.shape and torch.equal(context, ref_context)
+            error = (hint - ref_hint).abs().max().item() if ok else float('inf')
+            ok = ok and error <= args.atol
+            failed = failed or not ok
+            print(f"{name:36s} {'ok  ' if ok else 'FAIL'} max abs {error:.2e} hint {tuple(hint.shape)} "
+                  f"lean {lean_s * 1e3:7.2f} ms, monai {monai_s * 1e3:7.2f} ms ({monai_s / lean_s:4.1f}x)")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import argparse
+import subprocess
+import sys
+
+
+def import_times(module):
+    # Cumulative import time in seconds of every top-level package pulled in by a cold `import module`
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package", nested imports are indented
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith('  '):
+            continue
+        name = name.strip().split('.')[0]
+        times[name] = times.get(name, 0.) + int(cumulative) / 1e6
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold import time of the worker module, by top-level package')
+    parser.add_argument('--module', type=str, default='tools.inference')
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--forbid', type=str, nargs='*', default=['monai', 'pika', 'nibabel', 'requests', 'tqdm', 'yaml'],
+                        help='packages that must not be imported eagerly')
+    args = parser.parse_args()
+
+    times = import_times(args.module)
+    print(f'import {args.module}: {sum(times.values()):.3f}s')
+    for name, seconds in sorted(times.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'  {name:24s} {seconds:8.3f}s')
+    eager = [name for name in args.forbid if name in times]
+    if eager:
+        print(f'[ERROR] imported eagerly: {", ".join(eager)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
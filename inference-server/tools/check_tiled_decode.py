@@ -0,0 +1,107 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import numpy as np
+import torch
+from models import const
+from models.vqvae import VQVAE
+from models.tiled_decode import TiledDecoder
+from worker.model_registry import load_config, strip_compile_prefix
+
+
+def load_vqvae(config, random_weights):
+    vqvae_config = config['vqvae_params']
+    vqvae = VQVAE(im_channels=vqvae_config['im_channels'], model_config=vqvae_config).eval()
+    if not random_weights:
+        ckpt = torch.load(config['train_params']['vqvae_best_ckpt_name'], map_location='cpu')
+        vqvae.load_state_dict(strip_compile_prefix(ckpt['model_state_dict']))
+    for p in vqvae.parameters():
+        p.requires_grad_(False)
+    return vqvae
+
+
+def load_latent(path):
+    if path is None:
+        torch.manual_seed(0)
+        return torch.randn((1, *const.LATENT_SHAPE_DM))
+    z = torch.from_numpy(np.load(path)).float()
+    return z.unsqueeze(0) if z.dim() == 4 else z
+
+
+def seam_mask(decoder, spatial_shape):
+    # Image voxels covered by more than one tile
+    f = decoder.scale_factor
+    coverage = torch.zeros([size * f for size in spatial_shape])
+    for start in decoder.tiles(spatial_shape):
+        index = tuple(slice(s * f, (s + min(tile, size)) * f)
+                      for s, tile, size in zip(start, decoder.tile_size, spatial_shape))
+        coverage[index] += 1
+    return coverage > 1
+
+
+@torch.no_grad()
+def run_decode(config_path, random_weights, latent_path, tiled, tiled_args, queue):
+    # Runs in a fresh process so the peak RSS belongs to this decode alone
+    config = load_config(config_path)
+    vqvae = load_vqvae(config, random_weights)
+    z = load_latent(latent_path)
+    decode = vqvae.decode
+    if tiled:
+        decode = TiledDecoder(vqvae.decode, 2 ** sum(vqvae.down_sample), **tiled_args)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    out = decode(z)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((out.numpy(), elapsed, peak - baseline))
+
+
+def isolated(*args):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_decode, args=args + (queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seam error and peak memory of the tiled vs monolithic VQVAE decode')
+    parser.add_argument('--config', dest='config_path', default='config/adni.yaml', type=str)
+    parser.add_argument('--latent', type=str, default=None,
+                        help='.npy latent (C, D, H, W) as passed to the decoder, random if not given')
+    parser.add_argument('--random_weights', action='store_true')
+    parser.add_argument('--tile_size', type=int, nargs=3, default=[16, 16, 16])
+    parser.add_argument('--overlap', type=int, default=4)
+    parser.add_argument('--window', type=str, default='cosine', choices=['linear', 'cosine'])
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--max_abs_tol', type=float, default=None,
+                        help='exit non-zero if the decoded error (in [0, 1] intensities) exceeds this')
+    args = parser.parse_args()
+
+    tiled_args = {'tile_size': args.tile_size, 'overlap': args.overlap,
+                  'window': args.window, 'num_workers': args.num_workers}
+    full, full_time, full_rss = isolated(args.config_path, args.random_weights, args.latent, False, tiled_args)
+    tiled, tiled_time, tiled_rss = isolated(args.config_path, args.random_weights, args.latent, True, tiled_args)
+
+    # Compare as served: clamped and mapped to [0, 1]
+    full = (np.clip(full, -1., 1.) + 1) / 2
+    tiled = (np.clip(tiled, -1., 1.) + 1) / 2
+    error = np.abs(full - tiled)[0, 0]
+    latent_shape = tuple(load_latent(args.latent).shape[2:])
+    decoder = TiledDecoder(None, full.shape[-1] // latent_shape[-1], **tiled_args)
+    seams = seam_mask(decoder, latent_shape).numpy()
+
+    print(f'tiles           : {len(decoder.tiles(latent_shape))}')
+    print(f'max abs error   : {error.max():.4e} (seams {error[seams].max() if seams.any() else 0.:.4e})')
+    print(f'mean abs error  : {error.mean():.4e} (seams {error[seams].mean() if seams.any() else 0.:.4e})')
+    print(f'monolithic      : {full_time:.2f}s, peak RSS +{full_rss:.0f} MB')
+    print(f'tiled           : {tiled_time:.2f}s, peak RSS +{tiled_rss:.0f} MB')
+    if args.max_abs_tol is not None and error.max() > args.max_abs_tol:
+        raise SystemExit(f'Tiled decode error {error.max():.4e} exceeds {args.max_abs_tol:.0e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import argparse
+import torch
+from utils.config_utils import get_config_value
+from worker.model_registry import load_config, build_models
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the compiled controlnet artifacts ahead of deployment')
+    parser.add_argument('--config', dest='config_path',
+                        default='config/adni.yaml', type=str)
+    parser.add_argument('--backend', type=str, default=None,
+                        help="overrides inference_params.compile.backend ('inductor', 'trace' or 'export')")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=None)
+    args = parser.parse_args()
+
+    config = load_config(args.config_path)
+    inference_config = config.setdefault('inference_params', {})
+    compile_config = inference_config.setdefault('compile', {})
+    compile_config['enabled'] = True
+    if args.backend is not None:
+        compile_config['backend'] = args.backend
+    if args.batch_sizes is not None:
+        compile_config['batch_sizes'] = args.batch_sizes
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    models = build_models(config, device)
+    built = sorted(models.denoiser.compiled.keys())
+    print(f"Compiled batch sizes: {built} of {get_config_value(compile_config, 'batch_sizes', [1])}")
+
+
+if __name__ == '__main__':
+    main()
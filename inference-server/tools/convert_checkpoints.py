@@ -0,0 +1,70 @@
+import argparse
+import os
+import time
+import torch
+from worker.model_registry import load_config, load_mmap_state_dict, strip_compile_prefix
+
+
+def rss_mb():
+    # Current resident set size of this process
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.
+
+
+def convert_checkpoint(src, dst):
+    # Training checkpoint -> flat state dict with normalised keys and contiguous tensors,
+    # saved in torch's zip format, whose storages torch.load(mmap=True) maps in place
+    ckpt = torch.load(src, map_location='cpu')
+    state_dict = strip_compile_prefix(ckpt['model_state_dict'])
+    state_dict = {k: v.detach().contiguous() for k, v in state_dict.items()}
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    torch.save(state_dict, dst)
+    return state_dict
+
+
+def compare_loads(src, dst):
+    # Load time and RSS growth of the pickled checkpoint vs the mapped one
+    before = rss_mb()
+    start = time.perf_counter()
+    ckpt = torch.load(src, map_location='cpu')
+    state_dict = strip_compile_prefix(ckpt['model_state_dict'])
+    pickled = (time.perf_counter() - start, rss_mb() - before)
+    del ckpt, state_dict
+
+    before = rss_mb()
+    start = time.perf_counter()
+    state_dict = load_mmap_state_dict(dst)
+    mapped = (time.perf_counter() - start, rss_mb() - before)
+    del state_dict
+    return pickled, mapped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write memory-mappable controlnet / vqvae checkpoints')
+    parser.add_argument('--config', dest='config_path', default='config/adni.yaml', type=str)
+    args = parser.parse_args()
+
+    config = load_config(args.config_path)
+    train_config = config['train_params']
+    mmap_config = config['inference_params']['mmap_checkpoints']
+    pairs = [(train_config['controlnet_best_ckpt_name'], mmap_config['controlnet_ckpt_name']),
+             (train_config['vqvae_best_ckpt_name'], mmap_config['vqvae_ckpt_name'])]
+
+    for src, dst in pairs:
+        state_dict = convert_checkpoint(src, dst)
+        reloaded = load_mmap_state_dict(dst)
+        assert reloaded.keys() == state_dict.keys()
+        assert all(torch.equal(reloaded[k], v) for k, v in state_dict.items()), f'{dst} differs from {src}'
+        print(f'Wrote {dst} ({len(state_dict)} tensors)')
+        del state_dict, reloaded
+
+        (pickled_time, pickled_rss), (mapped_time, mapped_rss) = compare_loads(src, dst)
+        print(f'  torch.load      : {pickled_time:.3f}s, RSS +{pickled_rss:.0f} MB')
+        print(f'  torch.load mmap : {mapped_time:.3f}s, RSS +{mapped_rss:.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
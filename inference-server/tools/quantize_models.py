@@ -0,0 +1,103 @@
+import argparse
+import copy
+import glob
+import os
+import torch
+from tools import inference
+from models.quantization import quantize_models
+from worker.model_registry import LoadedModels, load_config, build_models
+
+# (sex, target diagnosis, starting age, target age) cycled over the calibration latents
+CALIBRATION_COVARIATES = [
+    (0, 0., 0.70, 0.75),
+    (1, 0.5, 0.72, 0.80),
+    (0, 1., 0.78, 0.85),
+    (1, 0., 0.65, 0.70),
+]
+
+
+def run_pipeline(models, context, controlnet_condition, seed, num_steps):
+    sampler = inference.build_sampler(models, 'ddim', num_steps, seed)
+    xt = inference.sample_latents(models, context, controlnet_condition, sampler)
+    return xt, inference.decode_latents(models, xt)
+
+
+def prepare_inputs(path, idx):
+    sex, diagnosis, starting_age, target_age = CALIBRATION_COVARIATES[idx % len(CALIBRATION_COVARIATES)]
+    return inference.preprocess(path, sex, diagnosis, starting_age, target_age)
+
+
+@torch.no_grad()
+def voxel_error(reference_models, quantized_models, paths, num_steps):
+    # Worst-case and mean absolute voxel error of the decoded volume (intensities in [0, 1]),
+    # end to end and for the decoder alone on the fp32 latent
+    report = {'max_abs': 0., 'mean_abs': 0., 'decoder_max_abs': 0., 'decoder_mean_abs': 0.}
+    for idx, path in enumerate(paths):
+        context, controlnet_condition = prepare_inputs(path, idx)
+        reference_xt, reference = run_pipeline(reference_models, context, controlnet_condition, idx, num_steps)
+        _, quantized = run_pipeline(quantized_models, context, controlnet_condition, idx, num_steps)
+        decoder_only = inference.decode_latents(quantized_models, reference_xt)
+
+        error = (reference - quantized).abs()
+        decoder_error = (reference - decoder_only).abs()
+        report['max_abs'] = max(report['max_abs'], error.max().item())
+        report['mean_abs'] += error.mean().item() / len(paths)
+        report['decoder_max_abs'] = max(report['decoder_max_abs'], decoder_error.max().item())
+        report['decoder_mean_abs'] += decoder_error.mean().item() / len(paths)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write int8 ControlNet / VQVAE decoder checkpoints for CPU inference')
+    parser.add_argument('--config', dest='config_path',
+                        default='config/adni.yaml', type=str)
+    parser.add_argument('--calibration_dir', type=str, required=True,
+                        help='directory of stored .npy latents used to calibrate activation ranges')
+    parser.add_argument('--num_calibration', type=int, default=4)
+    parser.add_argument('--num_eval', type=int, default=2)
+    parser.add_argument('--num_steps', type=int, default=10,
+                        help='DDIM steps per calibration / evaluation sample')
+    args = parser.parse_args()
+
+    config = load_config(args.config_path)
+    inference_config = config.setdefault('inference_params', {})
+    quantization_config = inference_config.get('quantization', {})
+    # Start from the plain fp32 models
+    inference_config['quantization'] = {'enabled': False}
+    inference_config['fused_encoder'] = False
+    inference_config['compile'] = {'enabled': False}
+
+    # Calibration runs on the CPU the quantized kernels target
+    device = torch.device('cpu')
+    inference._device = device
+    models = build_models(config, device)
+    reference = LoadedModels(config, copy.deepcopy(models.controlnet), copy.deepcopy(models.vqvae),
+                             models.scheduler, device)
+
+    paths = sorted(glob.glob(os.path.join(args.calibration_dir, '*.npy')))
+    assert paths, f"No .npy latents found in {args.calibration_dir}"
+    calibration_paths = paths[:args.num_calibration]
+
+    def calibrate():
+        for idx, path in enumerate(calibration_paths):
+            print(f'Calibrating on {path}')
+            context, controlnet_condition = prepare_inputs(path, idx)
+            run_pipeline(models, context, controlnet_condition, idx, args.num_steps)
+
+    quantize_models(models.controlnet, models.vqvae, calibrate,
+                    backend=quantization_config.get('backend', 'fbgemm'))
+
+    report = voxel_error(reference, models, paths[:args.num_eval], args.num_steps)
+    print(f"Decoded voxel error vs fp32: {report}")
+
+    controlnet_path = quantization_config.get('controlnet_ckpt_name', 'checkpoints/controlnet_int8.pth')
+    vqvae_path = quantization_config.get('vqvae_ckpt_name', 'checkpoints/vqvae_int8.pth')
+    for path in (controlnet_path, vqvae_path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save({'model_state_dict': models.controlnet.state_dict(), 'error_bound': report}, controlnet_path)
+    torch.save({'model_state_dict': models.vqvae.state_dict(), 'error_bound': report}, vqvae_path)
+    print(f'Saved int8 checkpoints to {controlnet_path} and {vqvae_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import functools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# RabbitMQ consumer with manual acks. The broker hands out at most `prefetch` unacked messages,
+# each is handled on a worker thread (up to `prefetch` jobs in flight), and the ack is sent back
+# on the connection's I/O thread through add_callback_threadsafe once the handler reports
+# success, i.e. after the upload. The I/O thread never blocks on inference, so heartbeats keep
+# flowing, and a message whose worker crashes is redelivered instead of lost.
+class AckingConsumer:
+    def __init__(self, connection, channel, queue, handle_fn, prefetch=4, requeue_on_failure=False):
+        # handle_fn(body) -> True once the job is done, False / raises on failure
+        self.connection = connection
+        self.channel = channel
+        self.queue = queue
+        self.handle_fn = handle_fn
+        self.prefetch = prefetch
+        self.requeue_on_failure = requeue_on_failure
+        self._executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='consumer')
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def _on_message(self, channel, method, properties, body):
+        with self._lock:
+            self.in_flight += 1
+        self._executor.submit(self._handle, method.delivery_tag, body)
+
+    def _handle(self, delivery_tag, body):
+        try:
+            ok = bool(self.handle_fn(body))
+        except Exception as e:
+            print(f"[ERROR] Failed to handle message: {e}")
+            ok = False
+        with self._lock:
+            self.in_flight -= 1
+        self.connection.add_callback_threadsafe(functools.partial(self._settle, delivery_tag, ok))
+
+    def _settle(self, delivery_tag, ok):
+        # Runs on the I/O thread, the only thread allowed to use the channel
+        if ok:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+        else:
+            print(f"[ERROR] Job failed, {'requeueing' if self.requeue_on_failure else 'rejecting'} message")
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=self.requeue_on_failure)
+
+    def start(self):
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self._on_message, auto_ack=False)
+        try:
+            self.channel.start_consuming()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+# Groups messages handed over by the consumer's threads into batches: up to batch_size, or whatever
+# arrived within batch_timeout seconds of the first one. submit() returns a Future resolving to that
+# message's own outcome, so each message is acked or nacked on its own once its batch ran.
+class MessageBatcher:
+    def __init__(self, process_fn, batch_size, batch_timeout):
+        # process_fn(items) -> one outcome per item
+        self.process_fn = process_fn
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self._pending = []
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def submit(self, item):
+        future = Future()
+        with self._cond:
+            self._pending.append((item, future))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._stop:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            deadline = time.monotonic() + self.batch_timeout
+            while len(self._pending) < self.batch_size and not self._stop:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                outcomes = self.process_fn([item for item, _ in batch])
+            except Exception as e:
+                print(f"[ERROR] Failed to process batch: {e}")
+                outcomes = [False] * len(batch)
+            for (_, future), ok in zip(batch, outcomes):
+                future.set_result(bool(ok))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='message-batcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Runs what was already submitted, then stops
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
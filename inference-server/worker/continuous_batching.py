@@ -0,0 +1,128 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import torch
+from models import const
+from models.controlnet import InferenceCache
+from worker.metrics import DENOISING_STEPS, STAGE_SECONDS
+
+
+class InFlightSample:
+    def __init__(self, context, hint, sampler, xt, future, cache=None):
+        self.context = context
+        self.hint = hint
+        self.cache = cache
+        self.sampler = sampler
+        self.xt = xt
+        self.future = future
+        self.step_index = 0
+        self.started_at = None
+
+    @property
+    def timestep(self):
+        return self.sampler.timesteps[self.step_index]
+
+    @property
+    def done(self):
+        return self.step_index >= len(self.sampler.timesteps)
+
+
+# Keeps a running batch of in-flight samples, each at its own timestep (and with its own sampler).
+# New jobs join and finished ones leave at step boundaries, so a job never waits for a whole
+# batch to finish. Finished samples are decoded on a separate thread while the rest keep denoising.
+# submit() blocks while max_pending samples wait to join, so call it from worker threads, never
+# from the broker connection's I/O thread.
+class ContinuousBatchingEngine:
+    def __init__(self, models, decode_fn, max_batch_size=4, use_cache=False, max_pending=None):
+        self.models = models
+        self.decode_fn = decode_fn
+        self.max_batch_size = max_batch_size
+        self.use_cache = use_cache
+        self._pending = queue.Queue(maxsize=max_pending or max_batch_size)
+        self._active = []
+        self._decoder = ThreadPoolExecutor(max_workers=1)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, context, hint, sampler):
+        # context: (1, context_dim), hint: (1, hint_channels, D, H, W)
+        # returns a Future resolving to the decoded volume
+        future = Future()
+        xt = torch.randn((context.size(0), *const.LATENT_SHAPE_DM),
+                         generator=sampler.generator, device=self.models.device)
+        cache = None
+        if self.use_cache:
+            cache = self.models.controlnet.build_inference_cache(context, hint, self.models.scheduler.num_timesteps)
+        self._pending.put(InFlightSample(context, hint, sampler, xt, future, cache))
+        return future
+
+    @property
+    def num_active(self):
+        return len(self._active)
+
+    def _admit(self):
+        while len(self._active) < self.max_batch_size:
+            try:
+                # Only wait for work when nothing is denoising
+                sample = self._pending.get(block=not self._active, timeout=0.1)
+            except queue.Empty:
+                break
+            if sample.future.set_running_or_notify_cancel():
+                sample.started_at = time.perf_counter()
+                self._active.append(sample)
+
+    @torch.no_grad()
+    def step(self):
+        # Runs one denoising step over every active sample, returns False when idle
+        self._admit()
+        if not self._active:
+            return False
+
+        active = self._active
+        device = self.models.device
+        xt = torch.cat([s.xt for s in active], dim=0)
+        t = torch.tensor([s.timestep for s in active], device=device, dtype=torch.long)
+        context = torch.cat([s.context for s in active], dim=0)
+        hint = torch.cat([s.hint for s in active], dim=0)
+        cache = InferenceCache.concat([s.cache for s in active]) if self.use_cache else None
+
+        try:
+            noise_pred = self.models.denoiser(xt, t, context, hint, cache=cache)
+            for k, s in enumerate(active):
+                s.xt, _ = s.sampler.step(xt[k:k + 1], noise_pred[k:k + 1], s.step_index)
+                s.step_index += 1
+        except Exception as e:
+            for s in active:
+                s.future.set_exception(e)
+            self._active = []
+            return True
+
+        DENOISING_STEPS.inc(len(active))
+        self._active = [s for s in active if not s.done]
+        for s in active:
+            if s.done:
+                STAGE_SECONDS.observe(time.perf_counter() - s.started_at, stage='sampling')
+                self._decoder.submit(self._decode, s)
+        return True
+
+    def _decode(self, sample):
+        try:
+            with torch.no_grad():
+                sample.future.set_result(self.decode_fn(sample.xt))
+        except Exception as e:
+            sample.future.set_exception(e)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.step()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='continuous-batching', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._decoder.shutdown(wait=True)
@@ -0,0 +1,144 @@
+import io
+import os
+import gzip
+import time
+import uuid
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+# Idempotent GETs are retried on any of these
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# The upload completes the job on the backend, which may have stored the result before answering
+# with a 500 / 502 / 504, so it is only re-sent when the backend surely did not process it
+UPLOAD_RETRY_STATUSES = (429, 503)
+
+
+class MultipartStream:
+    # multipart/form-data body with a single file part, read from disk in chunks while it is
+    # sent. Has a length, so requests sends a Content-Length instead of a chunked body
+    def __init__(self, path, field='file', content_type='application/octet-stream', chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        filename = os.path.basename(path)
+        self._head = (f'--{self.boundary}\r\n'
+                      f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                      f'Content-Type: {content_type}\r\n\r\n').encode()
+        self._tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self._length = len(self._head) + os.path.getsize(path) + len(self._tail)
+        self._file = open(path, 'rb')
+        self._buffer = self._head
+        self._offset = 0
+        self._done = False
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self._length
+
+    def _next_buffer(self):
+        chunk = self._file.read(self.chunk_size)
+        if chunk:
+            return chunk
+        self._done = True
+        return self._tail
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        parts = []
+        while size > 0:
+            if self._offset >= len(self._buffer):
+                if self._done:
+                    break
+                self._buffer = self._next_buffer()
+                self._offset = 0
+            part = self._buffer[self._offset:self._offset + size]
+            self._offset += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def close(self):
+        self._file.close()
+
+
+def read_volume(data):
+    # Decodes a downloaded volume without touching the disk: .npy latents as written by
+    # np.save, or a NIfTI (optionally gzipped) image. Returns the array and its affine
+    if data[:6] == b'\x93NUMPY':
+        return np.load(io.BytesIO(data), allow_pickle=False), np.eye(4)
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    import nibabel as nib
+    image = nib.Nifti1Image.from_bytes(data)
+    return np.asarray(image.dataobj), image.affine
+
+
+# Keep-alive connection pool shared by all downloads and uploads of a worker process.
+# Idempotent requests are retried by urllib3, uploads by upload_file with a fresh body per attempt,
+# only on connection errors and UPLOAD_RETRY_STATUSES
+class HttpClient:
+    def __init__(self, headers=None, timeout=(5., 60.), retries=3, backoff=0.5, pool_size=8,
+                 chunk_size=CHUNK_SIZE):
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        # Imported here so importing the worker does not pay for requests / urllib3
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self._connection_error = requests.ConnectionError
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url, save_path):
+        # Streams the body to a .part file next to save_path, renamed once complete
+        partial_path = save_path + '.part'
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to download {url}. Status code: {response.status_code}")
+            with open(partial_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+        os.replace(partial_path, save_path)
+        return save_path
+
+    def fetch(self, url):
+        # Whole body in memory, for inputs handed straight to read_volume
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to download {url}. Status code: {response.status_code}")
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                data += chunk
+        return data
+
+    def upload_file(self, url, path, params=None, headers=None, field='file'):
+        # Streamed multipart upload, retried on connection errors and UPLOAD_RETRY_STATUSES
+        for attempt in range(self.retries + 1):
+            body = MultipartStream(path, field=field, chunk_size=self.chunk_size)
+            request_headers = dict(headers or {})
+            request_headers['Content-Type'] = body.content_type
+            try:
+                response = self.session.post(url, params=params, data=body, headers=request_headers,
+                                             timeout=self.timeout)
+            except self._connection_error as e:
+                if attempt == self.retries:
+                    raise
+                print(f"[ERROR] Upload attempt {attempt + 1} failed: {e}")
+            else:
+                if response.status_code not in UPLOAD_RETRY_STATUSES or attempt == self.retries:
+                    return response
+                print(f"[ERROR] Upload attempt {attempt + 1} failed: {response.status_code}")
+            finally:
+                body.close()
+            time.sleep(self.backoff * (2 ** attempt))
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,250 @@
+import contextlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latencies from a fast preprocess up to a slow full sampling loop on CPU
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600., 1800.)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        assert set(labels) == set(self.labelnames), f'{self.name} takes labels {self.labelnames}'
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        # (suffix, label string, value) lines of the exposition format
+        return [('', _format_labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1., **labels):
+        self.registry.update(self.name, 'inc', self._key(labels), amount)
+
+    def _apply(self, op, key, value):
+        self._values[key] = self._values.get(key, 0.) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        super().__init__(registry, name, help_text, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        self.registry.update(self.name, 'set', self._key(labels), value)
+
+    def inc(self, amount=1., **labels):
+        self.registry.update(self.name, 'inc', self._key(labels), amount)
+
+    def dec(self, amount=1., **labels):
+        self.registry.update(self.name, 'inc', self._key(labels), -amount)
+
+    def set_function(self, fn):
+        # Sampled on every scrape instead of being updated
+        self._function = fn
+
+    def value(self, **labels):
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0.)
+
+    def _apply(self, op, key, value):
+        if op == 'set':
+            self._values[key] = value
+        else:
+            self._values[key] = self._values.get(key, 0.) + value
+
+    def samples(self):
+        if self._function is not None:
+            return [('', '', self._function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.registry.update(self.name, 'observe', self._key(labels), value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _apply(self, op, key, value):
+        # [per bucket counts..., sum, count]
+        counts = self._values.setdefault(key, [0] * len(self.buckets) + [0., 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self):
+        lines = []
+        for key, counts in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(('_bucket', _format_labels(self.labelnames, key, [('le', bound)]), count))
+            lines.append(('_bucket', _format_labels(self.labelnames, key, [('le', '+Inf')]), counts[-1]))
+            lines.append(('_sum', _format_labels(self.labelnames, key), counts[-2]))
+            lines.append(('_count', _format_labels(self.labelnames, key), counts[-1]))
+        return lines
+
+
+# Process-local metrics rendered in the Prometheus text format. Forked worker processes call
+# forward_to() so their updates travel over a queue to the parent, which applies them with
+# collect_from() and serves the totals of the whole pod from one endpoint.
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._forward = None
+
+    def register(self, metric):
+        assert metric.name not in self._metrics, f'{metric.name} registered twice'
+        self._metrics[metric.name] = metric
+
+    def update(self, name, op, key, value):
+        if self._forward is not None:
+            self._forward.put((name, op, key, value))
+            return
+        with self._lock:
+            self._metrics[name]._apply(op, key, value)
+
+    def forward_to(self, queue):
+        self._forward = queue
+
+    def collect_from(self, queue):
+        def drain():
+            while True:
+                name, op, key, value = queue.get()
+                with self._lock:
+                    self._metrics[name]._apply(op, key, value)
+        threading.Thread(target=drain, name='metrics-collector', daemon=True).start()
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append(f'# HELP {metric.name} {metric.help_text}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+                for suffix, labels, value in metric.samples():
+                    lines.append(f'{metric.name}{suffix}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def rss_bytes(pids=None):
+    # Resident memory of this process plus the given (worker) processes
+    total = 0
+    for pid in [os.getpid()] + list(pids or []):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            # Exited in between
+            pass
+    return total
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = Histogram(REGISTRY, 'inference_stage_seconds',
+                          'Wall time of each job stage (download, preprocess, sampling, decode, upload)', ('stage',))
+STAGE_FAILURES = Counter(REGISTRY, 'inference_stage_failures_total', 'Stages that raised', ('stage',))
+QUEUE_WAIT_SECONDS = Histogram(REGISTRY, 'inference_queue_wait_seconds',
+                               'Time between a message reaching the worker and its download starting')
+JOBS = Counter(REGISTRY, 'inference_jobs_total', 'Finished jobs by outcome (succeeded, failed, cached)', ('outcome',))
+IN_FLIGHT = Gauge(REGISTRY, 'inference_jobs_in_flight', 'Jobs received and not finished yet')
+DENOISING_STEPS = Counter(REGISTRY, 'inference_denoising_steps_total',
+                          'Denoising steps run, counted per sample (rate() gives steps/s)')
+RESULT_CACHE = Counter(REGISTRY, 'inference_result_cache_lookups_total', 'Result cache lookups', ('result',))
+MODELS_WARM = Gauge(REGISTRY, 'inference_models_warm', 'Whether a process has its models loaded and warmed up',
+                    ('pid',))
+STARTUP_SECONDS = Gauge(REGISTRY, 'inference_startup_seconds',
+                        'Wall time of each start-up phase (interpreter, imports, config, model_load, warmup, broker)',
+                        ('phase',))
+RSS_BYTES = Gauge(REGISTRY, 'inference_resident_memory_bytes', 'Resident memory of the worker and its processes')
+RSS_BYTES.set_function(rss_bytes)
+
+
+@contextlib.contextmanager
+def track(stage):
+    # Times one stage of a job and counts it as failed when it raises
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # /metrics for the scraper, /healthz for the liveness probe (the process is up) and
+    # /ready for the readiness probe (models loaded and warm, safe to take traffic)
+    registry = REGISTRY
+    ready_fn = staticmethod(lambda: False)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, self.registry.render(), 'text/plain; version=0.0.4')
+        elif self.path == '/healthz':
+            self._reply(200, 'ok\n')
+        elif self.path == '/ready':
+            ready = self.ready_fn()
+            self._reply(200 if ready else 503, 'ready\n' if ready else 'warming up\n')
+        else:
+            self._reply(404, 'not found\n')
+
+    def _reply(self, status, body, content_type='text/plain'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Scrapes and probes every few seconds would drown the job logs
+        pass
+
+
+def start_server(port, ready_fn, host='0.0.0.0', registry=REGISTRY):
+    # Serves on a daemon thread, returns the server (shutdown() to stop)
+    handler = type('Handler', (_Handler,), {'registry': registry, 'ready_fn': staticmethod(ready_fn)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import contextlib
+import threading
+import torch
+from models import const
+from models.vqvae import VQVAE
+from models.controlnet import ControlNet
+from models.blocks import set_attention_chunk_size
+from models.compiled_denoiser import compile_denoiser, make_fingerprint
+from models.precision import DTYPES, AutocastCall, prepare_mixed_precision
+from models.tiled_decode import TiledDecoder
+from utils.config_utils import get_config_value
+from scheduler.linear_noise_scheduler import LinearNoiseScheduler
+
+
+def load_config(config_path):
+    import yaml
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def compile_settings(config):
+    # Settings that change the compiled graph, part of the artifact fingerprint
+    inference_config = get_config_value(config, 'inference_params', {})
+    return json.dumps({
+        'ldm_params': config['ldm_params'],
+        'fused_encoder': get_config_value(inference_config, 'fused_encoder', False),
+        'precision': get_config_value(inference_config, 'precision', {}),
+        'attention_chunk_size': get_config_value(inference_config, 'attention_chunk_size', None),
+    }, sort_keys=True)
+
+
+def strip_compile_prefix(state_dict):
+    # Checkpoints saved from a torch.compile'd module carry an "_orig_mod." prefix
+    return {k.replace("_orig_mod.", ""): v for k, v in state_dict.items()}
+
+
+def load_mmap_state_dict(path):
+    # Flat state dict written by tools/convert_checkpoints.py: tensors are mapped from the file
+    # rather than read and copied, and forked workers share the page cache
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+
+def _mmap_config(config, device):
+    inference_config = get_config_value(config, 'inference_params', {})
+    mmap_config = get_config_value(inference_config, 'mmap_checkpoints', {})
+    quantization_config = get_config_value(inference_config, 'quantization', {})
+    if (not get_config_value(mmap_config, 'enabled', False)
+            or get_config_value(quantization_config, 'enabled', False)
+            or torch.device(device).type != 'cpu'):
+        return None
+    return mmap_config
+
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+class LoadedModels:
+    def __init__(self, config, controlnet, vqvae, scheduler, device):
+        self.config = config
+        self.controlnet = controlnet
+        # What the sampling loop calls: the controlnet itself or a compiled dispatcher around it
+        self.denoiser = controlnet
+        self.vqvae = vqvae
+        # Latent -> image, optionally wrapped for mixed precision like the denoiser
+        self.decoder = vqvae.decode
+        self.scheduler = scheduler
+        self.device = device
+        self.warm = False
+        # Weights mapped from mmap checkpoints are already shared between forked processes
+        self.mmap_loaded = False
+        # Batch sizes the denoiser runs compiled, which take no inference cache
+        self.compiled_batch_sizes = set()
+
+
+# Process-wide cache of eval-mode models, keyed by config path and checkpoint mtimes. get() runs for
+# every message, so the config is only re-parsed when its mtime changes and the files are stat'ed
+# for changes at most once per reload_interval seconds (None: only on the first call)
+class ModelRegistry:
+    def __init__(self, reload_interval=30.):
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._entries = {}
+        # config path -> (mtime, parsed config)
+        self._configs = {}
+        # (config path, device) -> (time.monotonic() of the last check, entry key)
+        self._checked = {}
+
+    @staticmethod
+    def _checkpoint_paths(config):
+        train_config = config['train_params']
+        inference_config = get_config_value(config, 'inference_params', {})
+        quantization_config = get_config_value(inference_config, 'quantization', {})
+        mmap_config = get_config_value(inference_config, 'mmap_checkpoints', {})
+        if get_config_value(quantization_config, 'enabled', False):
+            return [quantization_config['controlnet_ckpt_name'],
+                    quantization_config['vqvae_ckpt_name']]
+        if get_config_value(mmap_config, 'enabled', False):
+            return [mmap_config['controlnet_ckpt_name'],
+                    mmap_config['vqvae_ckpt_name']]
+        return [train_config['controlnet_best_ckpt_name'],
+                train_config['vqvae_best_ckpt_name']]
+
+    def _config(self, config_path):
+        mtime = _mtime(config_path)
+        cached = self._configs.get(config_path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, load_config(config_path))
+            self._configs[config_path] = cached
+        return cached
+
+    def _key(self, config_path, device):
+        config_mtime, config = self._config(config_path)
+        mtimes = (config_mtime,) + tuple(_mtime(p) for p in self._checkpoint_paths(config))
+        return (config_path, str(device), mtimes), config
+
+    def _recently_checked(self, config_path, device):
+        # Key of the last check when it is recent enough to skip the stat calls, else None
+        checked = self._checked.get((config_path, str(device)))
+        if checked is None or checked[1] not in self._entries:
+            return None
+        if self.reload_interval is not None and time.monotonic() - checked[0] >= self.reload_interval:
+            return None
+        return checked[1]
+
+    def get(self, config_path, device, warmup=False):
+        config_path = os.path.abspath(config_path)
+        with self._lock:
+            key = self._recently_checked(config_path, device)
+            if key is None:
+                key, config = self._key(config_path, device)
+                self._checked[(config_path, str(device))] = (time.monotonic(), key)
+            models = self._entries.get(key)
+            if models is None:
+                # Drop stale entries for the same config so old weights can be freed
+                self._entries = {k: v for k, v in self._entries.items() if k[:2] != key[:2]}
+                models = build_models(config, device)
+                self._entries[key] = models
+            if warmup and not models.warm:
+                warmup_models(models)
+            return models
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._configs.clear()
+            self._checked.clear()
+
+
+@torch.no_grad()
+def build_models(config, device, load_weights=True):
+    # load_weights=False leaves the models randomly initialised (benchmarks, precision checks)
+    diffusion_config = config['diffusion_params']
+    ldm_config = config['ldm_params']
+    vqvae_config = config['vqvae_params']
+    train_config = config['train_params']
+    inference_config = get_config_value(config, 'inference_params', {})
+    quantization_config = get_config_value(inference_config, 'quantization', {})
+    quantized = get_config_value(quantization_config, 'enabled', False)
+
+    mmap_config = _mmap_config(config, device) if load_weights else None
+
+    # The controlnet checkpoint holds both the locked trained unet and the controlnet copy,
+    # so the LDM checkpoint does not have to be read at all.
+    # With mmap checkpoints the modules are built without storage and the mapped tensors assigned.
+    with torch.device('meta') if mmap_config is not None else contextlib.nullcontext():
+        controlnet = ControlNet(im_channels=vqvae_config['z_channels'],
+                                model_config=ldm_config,
+                                model_locked=True)
+        vqvae = VQVAE(im_channels=vqvae_config['im_channels'],
+                      model_config=vqvae_config)
+    if mmap_config is None:
+        controlnet.to(device)
+        vqvae.to(device)
+    controlnet.eval()
+    vqvae.eval()
+
+    if not load_weights:
+        print('[DEBUG] Skipping checkpoint loading, models are randomly initialised')
+    elif mmap_config is not None:
+        controlnet_path = mmap_config['controlnet_ckpt_name']
+        vqvae_path = mmap_config['vqvae_ckpt_name']
+        assert os.path.exists(controlnet_path) and os.path.exists(vqvae_path), \
+            "mmap checkpoints not present. Run tools/convert_checkpoints.py first."
+        controlnet.load_state_dict(load_mmap_state_dict(controlnet_path), assign=True)
+        vqvae.load_state_dict(load_mmap_state_dict(vqvae_path), assign=True)
+        print(f'Mapped controlnet / vqvae weights from {controlnet_path} and {vqvae_path}')
+    elif quantized:
+        assert torch.device(device).type == 'cpu', "int8 quantized inference only runs on CPU"
+        # torch.ao.quantization is only imported by workers that run int8
+        from models.quantization import load_quantized
+        controlnet_path = quantization_config['controlnet_ckpt_name']
+        vqvae_path = quantization_config['vqvae_ckpt_name']
+        assert os.path.exists(controlnet_path) and os.path.exists(vqvae_path), \
+            "Quantized checkpoints not present. Run tools/quantize_models.py first."
+        controlnet_ckpt = torch.load(controlnet_path, map_location=device)
+        vqvae_ckpt = torch.load(vqvae_path, map_location=device)
+        load_quantized(controlnet, vqvae, controlnet_ckpt['model_state_dict'], vqvae_ckpt['model_state_dict'],
+                       backend=get_config_value(quantization_config, 'backend', 'fbgemm'))
+        print(f"Loaded int8 checkpoints (decoded voxel error vs fp32: {vqvae_ckpt.get('error_bound')})")
+        del controlnet_ckpt, vqvae_ckpt
+    else:
+        assert os.path.exists(train_config['controlnet_best_ckpt_name']), "Train ControlNet first"
+        checkpoint = torch.load(train_config['controlnet_best_ckpt_name'], map_location=device)
+        controlnet.load_state_dict(strip_compile_prefix(checkpoint['model_state_dict']))
+        del checkpoint
+        print('Loaded controlnet checkpoint')
+
+        path = train_config['vqvae_best_ckpt_name']
+        assert os.path.exists(path), \
+            "VQVAE checkpoint not present. Train VQVAE first."
+        ckpt = torch.load(path, map_location=device)
+        vqvae.load_state_dict(strip_compile_prefix(ckpt['model_state_dict']))
+        del ckpt
+        print('Loaded vqvae checkpoint')
+
+    scheduler = LinearNoiseScheduler(num_timesteps=diffusion_config['num_timesteps'],
+                                     beta_start=diffusion_config['beta_start'],
+                                     beta_end=diffusion_config['beta_end'],
+                                     ldm_scheduler=True)
+
+    for p in list(controlnet.parameters()) + list(vqvae.parameters()):
+        p.requires_grad_(False)
+
+    attention_chunk_size = get_config_value(inference_config, 'attention_chunk_size', None)
+    set_attention_chunk_size(controlnet, attention_chunk_size)
+    set_attention_chunk_size(vqvae, attention_chunk_size)
+
+    models = LoadedModels(config, controlnet, vqvae, scheduler, device)
+    models.mmap_loaded = mmap_config is not None
+
+    if get_config_value(inference_config, 'fused_encoder', False) and quantized:
+        # The fused layers copy float weights, which the int8 modules no longer have
+        print('[ERROR] fused_encoder is not supported with quantization, running unfused')
+    elif get_config_value(inference_config, 'fused_encoder', False):
+        # Fuse after the weights are loaded, and before compiling so the fused path is what gets compiled
+        controlnet.enable_fused_encoder()
+        print('Enabled fused controlnet encoder')
+
+    precision_config = get_config_value(inference_config, 'precision', {})
+    dtype = DTYPES[get_config_value(precision_config, 'dtype', 'float32')]
+    channels_last = get_config_value(precision_config, 'channels_last', False)
+    mixed_precision = (dtype != torch.float32 or channels_last) and not quantized
+    if quantized and (dtype != torch.float32 or channels_last):
+        print('[ERROR] precision settings are not supported with quantization, running int8 as is')
+    elif mixed_precision:
+        # Before compiling, so the fp32 GroupNorms and channels_last_3d weights are what gets compiled
+        prepare_mixed_precision(controlnet, channels_last)
+        prepare_mixed_precision(vqvae, channels_last)
+        if controlnet.fused_encoder is not None:
+            # Not a registered submodule of the controlnet, so converted separately
+            prepare_mixed_precision(controlnet.fused_encoder, channels_last)
+        print(f'Running controlnet / vqvae decode in {dtype} (channels_last_3d: {channels_last})')
+
+    compile_config = get_config_value(inference_config, 'compile', {})
+    if get_config_value(compile_config, 'enabled', False):
+        ckpt_path = ModelRegistry._checkpoint_paths(config)[0]
+        models.denoiser = compile_denoiser(
+            controlnet,
+            batch_sizes=get_config_value(compile_config, 'batch_sizes', [1]),
+            context_dim=ldm_config['condition_config']['context_condition_config']['context_embed_dim'],
+            hint_channels=ldm_config['hint_channels'],
+            device=device,
+            backend=get_config_value(compile_config, 'backend', 'inductor'),
+            cache_dir=get_config_value(compile_config, 'cache_dir', 'checkpoints/compiled'),
+            fingerprint=make_fingerprint(os.path.abspath(ckpt_path), _mtime(ckpt_path), device,
+                                         compile_settings(config)),
+            parity_atol=get_config_value(compile_config, 'parity_atol', 1e-3))
+        models.compiled_batch_sizes = set(models.denoiser.compiled)
+
+    if mixed_precision:
+        device_type = torch.device(device).type
+        models.denoiser = AutocastCall(models.denoiser, device_type, dtype, channels_last)
+        models.decoder = AutocastCall(vqvae.decode, device_type, dtype, channels_last)
+
+    tiled_config = get_config_value(inference_config, 'tiled_decode', {})
+    if get_config_value(tiled_config, 'enabled', False):
+        # Wraps the (autocast) per-tile decode, autocast state does not carry over to worker threads
+        models.decoder = TiledDecoder(
+            models.decoder,
+            scale_factor=2 ** sum(vqvae.down_sample),
+            tile_size=get_config_value(tiled_config, 'tile_size', [16, 16, 16]),
+            overlap=get_config_value(tiled_config, 'overlap', 4),
+            window=get_config_value(tiled_config, 'window', 'cosine'),
+            num_workers=get_config_value(tiled_config, 'num_workers', 1))
+        print(f'Enabled tiled vqvae decode ({tiled_config})')
+    return models
+
+
+@torch.no_grad()
+def warmup_models(models):
+    # One dummy denoising step and decode so allocator pools and kernels are ready
+    # before the first real job arrives
+    ldm_config = models.config['ldm_params']
+    context_dim = ldm_config['condition_config']['context_condition_config']['context_embed_dim']
+    device = models.device
+
+    xt = torch.zeros((1, *const.LATENT_SHAPE_DM), device=device)
+    t = torch.zeros((1,), dtype=torch.long, device=device)
+    context = torch.zeros((1, context_dim), device=device)
+    hint = torch.zeros((1, ldm_config['hint_channels'], *const.LATENT_SHAPE_DM[1:]), device=device)
+
+    models.denoiser(xt, t, context, hint)
+    models.decoder(xt)
+    models.warm = True
+    print('Warmed up models')
+
+
+_registry = ModelRegistry()
+
+
+def get_models(config_path, device, warmup=False):
+    return _registry.get(config_path, device, warmup=warmup)
@@ -0,0 +1,105 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_STOP = object()
+
+
+# Three stages with bounded hand-offs:
+#   prepare pool (download + preprocess) -> compute thread (owns the models) -> finish pool (save + upload)
+# so job N+1 is fetched while job N denoises and job N-1 uploads. submit() blocks once max_pending
+# jobs are waiting for the compute stage, and the compute stage blocks once max_finishing results
+# are waiting for upload, so memory stays bounded however fast messages arrive. submit() returns
+# a Future resolving to whether the job finished, so a consumer can ack it after the upload and
+# bound the pipeline with its prefetch window instead of blocking on the connection's I/O thread.
+class Pipeline:
+    def __init__(self, prepare_fn, compute_fn, finish_fn, batch_size=1, prepare_workers=2, finish_workers=2,
+                 max_pending=4, max_finishing=4):
+        # prepare_fn(item) -> job, or True / False when it finished / failed without the compute stage,
+        # compute_fn(jobs) -> one result per job, finish_fn(job, result) -> whether the job succeeded
+        self.prepare_fn = prepare_fn
+        self.compute_fn = compute_fn
+        self.finish_fn = finish_fn
+        self.batch_size = batch_size
+        self._pending_slots = threading.BoundedSemaphore(max_pending)
+        self._finishing_slots = threading.BoundedSemaphore(max_finishing)
+        self._prepared = queue.Queue()
+        self._prepare_pool = ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix='prepare')
+        self._finish_pool = ThreadPoolExecutor(max_workers=finish_workers, thread_name_prefix='finish')
+        self._thread = None
+
+    def submit(self, item):
+        # Blocks while the pipeline is full
+        self._pending_slots.acquire()
+        future = Future()
+        self._prepare_pool.submit(self._prepare, item, future)
+        return future
+
+    def _prepare(self, item, future):
+        try:
+            job = self.prepare_fn(item)
+        except Exception as e:
+            print(f"[ERROR] Failed to prepare job: {e}")
+            job = False
+        if isinstance(job, bool):
+            # Failed, or finished without the compute stage (e.g. a cached result)
+            self._pending_slots.release()
+            future.set_result(job)
+            return
+        self._prepared.put((job, future))
+
+    def _next_batch(self):
+        # Waits for one job, then takes whatever else is already prepared up to batch_size
+        entry = self._prepared.get()
+        if entry is _STOP:
+            return None
+        entries = [entry]
+        while len(entries) < self.batch_size:
+            try:
+                entry = self._prepared.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                self._prepared.put(_STOP)
+                break
+            entries.append(entry)
+        return entries
+
+    def _run(self):
+        while True:
+            entries = self._next_batch()
+            if entries is None:
+                return
+            try:
+                results = self.compute_fn([job for job, _ in entries])
+            except Exception as e:
+                print(f"[ERROR] Inference failed: {e}")
+                results = [None] * len(entries)
+            finally:
+                for _ in entries:
+                    self._pending_slots.release()
+            for (job, future), result in zip(entries, results):
+                self._finishing_slots.acquire()
+                self._finish_pool.submit(self._finish, job, result, future)
+
+    def _finish(self, job, result, future):
+        ok = False
+        try:
+            ok = bool(self.finish_fn(job, result))
+        except Exception as e:
+            print(f"[ERROR] Failed to finish job: {e}")
+        finally:
+            self._finishing_slots.release()
+            future.set_result(ok)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='pipeline-compute', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Drains what was already submitted, then stops every stage
+        self._prepare_pool.shutdown(wait=True)
+        self._prepared.put(_STOP)
+        if self._thread is not None:
+            self._thread.join()
+        self._finish_pool.shutdown(wait=True)
@@ -0,0 +1,191 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.nn.functional as F
+from models import const
+
+# Spatial size the controlnet hint is cropped / padded to
+SPATIAL_SIZE = (32, 40, 32)
+# Same tolerance MONAI uses to call a resampling transform the identity
+AFFINE_TOL = 1e-5
+
+# Fixed followup volumetric covariates of every request
+FOLLOWUP_VOLUMES = {
+    'followup_cerebral_cortex': 0.6491297655695000,
+    'followup_hippocampus': 0.6981271562345980,
+    'followup_amygdala': 0.7763787459078320,
+    'followup_cerebral_white_matter': 0.5346564766939970,
+    'followup_lateral_ventricle': 0.17370481207305900,
+}
+
+
+def covariates_context(sex, target_diagnosis, target_age):
+    # (1, 8) context vector in the order the controlnet was trained with
+    conditions = [target_age, sex, target_diagnosis] + list(FOLLOWUP_VOLUMES.values())
+    return torch.tensor(conditions, dtype=torch.float32).unsqueeze(0)
+
+
+def hint_from_latent(starting_z, starting_age):
+    # (C, D, H, W) starting latent + starting age broadcast as an extra channel -> (1, C + 1, D, H, W)
+    if starting_z.dim() == 4:
+        starting_z = starting_z.unsqueeze(0)
+    n = starting_z.shape[0]
+    starting_a = torch.tensor(starting_age, dtype=torch.float32, device=starting_z.device).view(1).expand(n)
+    concatenating_age = starting_a.view(n, 1, 1, 1, 1).expand(n, 1, *starting_z.shape[-3:])
+    return torch.cat([starting_z, concatenating_age], dim=1)
+
+
+def load_volume(source):
+    # File path or in-memory (array, affine) -> channel-first float32 array and its affine.
+    # .npy latents carry no affine, like MONAI's NumpyReader they get the identity
+    if isinstance(source, str):
+        if source.endswith('.npy'):
+            array, affine = np.load(source, allow_pickle=False), np.eye(4)
+        else:
+            import nibabel as nib
+            image = nib.load(source)
+            array, affine = np.asarray(image.dataobj), image.affine
+    else:
+        array, affine = source
+    array = np.asarray(array, dtype=np.float32)
+    assert array.ndim == 4, f"expected a channel-first (C, D, H, W) volume, got shape {array.shape}"
+    return array, np.asarray(affine, dtype=np.float64)
+
+
+def spacing_affine(affine, pixdim):
+    # Output affine of MONAI's Spacing(pixdim, diagonal=False): the input rotation kept, the zooms
+    # replaced by pixdim (MONAI's zoom_affine)
+    rzs = affine[:3, :3]
+    zs = np.linalg.cholesky(rzs.T @ rzs).T
+    rotation = rzs @ np.linalg.inv(zs)
+    scale = np.broadcast_to(np.asarray(pixdim, dtype=np.float64), (3,))
+    new_affine = np.eye(4)
+    new_affine[:3, :3] = rotation @ np.diag(np.sign(np.diag(zs)) * scale)
+    return new_affine
+
+
+def resample_plan(spatial_shape, affine, pixdim):
+    # Output shape and the (4, 4) map from output to input voxel indices of a resampling to pixdim,
+    # with the output grid spanning the input's voxel centres (MONAI's compute_shape_offset)
+    out_affine = spacing_affine(affine, pixdim)
+    corners = np.asarray(np.meshgrid(*[(0., size - 1.) for size in spatial_shape], indexing='ij')).reshape(3, -1)
+    corners = np.concatenate([corners, np.ones_like(corners[:1])])
+    corners_out = np.linalg.solve(out_affine, affine @ corners)[:3]
+    out_shape = tuple(int(size) for size in np.round(np.ptp(corners_out, axis=1) + 1.))
+    out_affine[:3, 3] = out_affine[:3, :3] @ corners_out.min(axis=1)
+    return out_shape, np.linalg.solve(affine, out_affine)
+
+
+def crop_pad_slices(spatial_shape, spatial_size):
+    # Source / destination slices of a center crop followed by a symmetric zero pad
+    # (MONAI's ResizeWithPadOrCrop), per spatial axis
+    src, dst = [], []
+    for size, target in zip(spatial_shape, spatial_size):
+        if size >= target:
+            start = size // 2 - target // 2
+            src.append(slice(start, start + target))
+            dst.append(slice(0, target))
+        else:
+            before = (target - size) // 2
+            src.append(slice(0, size))
+            dst.append(slice(before, before + size))
+    return tuple(src), tuple(dst)
+
+
+# Numpy / torch re-implementation of the MONAI Compose of preprocess(), built once per worker:
+# Spacing is skipped when the input already has const.RESOLUTION voxels, otherwise the sampling
+# grid is built once per (shape, affine) and reused, and the center crop / pad is a single
+# slice assignment (a view when nothing needs padding). Trilinear, border-clamped sampling
+# at voxel centres, as MONAI's bilinear Spacing with align_corners=False.
+# tools/check_preprocessing.py checks parity against MonaiPreprocessor.
+class Preprocessor:
+    def __init__(self, device, pixdim=const.RESOLUTION, spatial_size=SPATIAL_SIZE, max_grids=16):
+        self.device = torch.device(device)
+        self.pixdim = pixdim
+        self.spatial_size = tuple(spatial_size)
+        self.max_grids = max_grids
+        self._grids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _grid(self, spatial_shape, affine):
+        # (1, D', H', W', 3) grid_sample grid, or None when the resampling is the identity
+        key = (tuple(spatial_shape), affine.tobytes())
+        with self._lock:
+            if key in self._grids:
+                self._grids.move_to_end(key)
+                return self._grids[key]
+        out_shape, xform = resample_plan(spatial_shape, affine, self.pixdim)
+        grid = None
+        if out_shape != tuple(spatial_shape) or not np.allclose(xform, np.eye(4), atol=AFFINE_TOL):
+            index = np.stack(np.meshgrid(*[np.arange(size, dtype=np.float64) for size in out_shape],
+                                         indexing='ij'), axis=-1)
+            source = index @ xform[:3, :3].T + xform[:3, 3]
+            # Voxel index -> [-1, 1] with align_corners=False, grid_sample wants (x, y, z) = (W, H, D)
+            source = (2 * source + 1) / np.asarray(spatial_shape, dtype=np.float64) - 1
+            grid = torch.as_tensor(source[..., ::-1].copy(), dtype=torch.float32, device=self.device)[None]
+        with self._lock:
+            self._grids[key] = grid
+            while len(self._grids) > self.max_grids:
+                self._grids.popitem(last=False)
+        return grid
+
+    def resample(self, x, affine):
+        grid = self._grid(x.shape[1:], affine)
+        if grid is None:
+            return x
+        return F.grid_sample(x[None], grid, mode='bilinear', padding_mode='border', align_corners=False)[0]
+
+    def crop_or_pad(self, x):
+        src, dst = crop_pad_slices(x.shape[1:], self.spatial_size)
+        x = x[(slice(None),) + src]
+        if tuple(x.shape[1:]) == self.spatial_size:
+            return x
+        out = x.new_zeros((x.shape[0],) + self.spatial_size)
+        out[(slice(None),) + dst] = x
+        return out
+
+    @torch.no_grad()
+    def __call__(self, source, sex, target_diagnosis, starting_age, target_age):
+        array, affine = load_volume(source)
+        x = torch.from_numpy(array).to(self.device)
+        starting_z = self.crop_or_pad(self.resample(x, affine))
+        context = covariates_context(sex, target_diagnosis, target_age).to(self.device)
+        return context, hint_from_latent(starting_z, starting_age)
+
+
+# The original MONAI Compose, built once instead of per call. MONAI is only imported when this
+# path is selected (inference_params.preprocessing: 'monai') or for parity checks
+class MonaiPreprocessor:
+    def __init__(self, device):
+        from monai import transforms
+        from monai.data.image_reader import NumpyReader
+        self.device = torch.device(device)
+        tail = [
+            transforms.EnsureChannelFirstD(keys=["starting_latent_path"], channel_dim=0),
+            transforms.SpacingD(keys=["starting_latent_path"], pixdim=const.RESOLUTION, mode="bilinear"),
+            transforms.EnsureTypeD(keys=["starting_latent_path"], data_type="tensor", track_meta=False),
+            transforms.ResizeWithPadOrCropD(keys=['starting_latent_path'], spatial_size=SPATIAL_SIZE),
+            transforms.ToTensorD(keys=['starting_latent_path'], track_meta=False),
+        ]
+        self.from_file = transforms.Compose(
+            [transforms.LoadImaged(keys=['starting_latent_path'], reader=NumpyReader())] + tail)
+        self.from_memory = transforms.Compose(
+            [transforms.Lambdad(keys=['starting_latent_path'], func=self.to_meta_tensor)] + tail)
+
+    @staticmethod
+    def to_meta_tensor(volume):
+        # (array, affine) decoded in memory -> what LoadImaged would have produced from the file
+        from monai.data import MetaTensor
+        array, affine = volume
+        return MetaTensor(np.asarray(array, dtype=np.float32), affine=torch.as_tensor(affine, dtype=torch.float64))
+
+    @torch.no_grad()
+    def __call__(self, source, sex, target_diagnosis, starting_age, target_age):
+        compose = self.from_file if isinstance(source, str) else self.from_memory
+        starting_z = compose({'starting_latent_path': source})['starting_latent_path'].to(self.device)
+        context = covariates_context(sex, target_diagnosis, target_age).to(self.device)
+        return context, hint_from_latent(starting_z, starting_age)
+
+
+PREPROCESSORS = {'lean': Preprocessor, 'monai': MonaiPreprocessor}
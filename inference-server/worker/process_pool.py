@@ -0,0 +1,210 @@
+import os
+import collections
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+import torch
+
+_STOP = None
+
+
+def partition_cores(num_workers, cores=None):
+    # Disjoint, contiguous core sets, one per worker
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    assert num_workers <= len(cores), f"{num_workers} workers need at least as many cores, have {len(cores)}"
+    per_worker = len(cores) // num_workers
+    return [cores[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+
+def share_models(models):
+    # Moves the weights into shared memory, so forked workers map the same pages instead of
+    # each ending up with a copy-on-write duplicate
+    if models.mmap_loaded:
+        # Already file backed and shared through the page cache, moving them would copy
+        return models
+    models.controlnet.share_memory()
+    models.vqvae.share_memory()
+    if models.controlnet.fused_encoder is not None:
+        models.controlnet.fused_encoder.share_memory()
+    return models
+
+
+def _worker_main(worker_id, cores, conn, init_fn, handle_fn):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before any inter-op work ran in this process
+        pass
+    print(f"Worker {worker_id} (pid {os.getpid()}) pinned to cores {cores}")
+    if init_fn is not None:
+        init_fn()
+    while True:
+        item = conn.recv()
+        if item is _STOP:
+            return
+        job_id, payload = item
+        ok = False
+        try:
+            ok = bool(handle_fn(payload))
+        except Exception as e:
+            print(f"[ERROR] Worker {worker_id} failed: {e}")
+        conn.send((job_id, ok))
+
+
+def _spawner_main(requests, ctx, core_sets, worker_conns, init_fn, handle_fn):
+    # Single threaded, forked once before the pool starts its threads: every worker, including the
+    # replacements, is forked from here and never inherits a lock held by a thread of the parent.
+    # Reports ('started' | 'exited', worker_id, pid, exitcode) back over `requests`
+    workers = {}
+
+    def spawn(worker_id):
+        process = ctx.Process(target=_worker_main, name=f'inference-worker-{worker_id}',
+                              args=(worker_id, core_sets[worker_id], worker_conns[worker_id], init_fn, handle_fn),
+                              daemon=True)
+        process.start()
+        workers[worker_id] = process
+        requests.send(('started', worker_id, process.pid, None))
+
+    while True:
+        if requests.poll(0.2):
+            request = requests.recv()
+            if request is _STOP:
+                break
+            spawn(request)
+        for worker_id, process in list(workers.items()):
+            if not process.is_alive():
+                del workers[worker_id]
+                requests.send(('exited', worker_id, process.pid, process.exitcode))
+    # The parent sent every worker _STOP already
+    for process in workers.values():
+        process.join()
+
+
+# Supervisor of N forked inference processes pinned to disjoint core sets. submit() returns a
+# Future resolving to whether the job succeeded, so the consumer acks after the work is done and
+# bounds the pool with its prefetch window. Each worker has its own pipe and at most one job: the
+# parent records the assignment before sending it, so the job of a worker that dies is always
+# failed, and no worker can wedge the others by dying on a shared queue lock. Workers are forked
+# (and respawned) by a helper process forked in start() before any thread of the pool exists.
+# Fork before anything runs parallel torch ops in the parent: an OpenMP pool that was already
+# used does not survive fork.
+class ProcessPool:
+    def __init__(self, num_workers, handle_fn, init_fn=None, cores=None):
+        # handle_fn(item) -> whether the job succeeded, runs in the workers
+        self.num_workers = num_workers
+        self.handle_fn = handle_fn
+        self.init_fn = init_fn
+        self.core_sets = partition_cores(num_workers, cores)
+        self._ctx = multiprocessing.get_context('fork')
+        # (parent end, worker end) per worker, reused by its replacements
+        self._conns = [self._ctx.Pipe() for _ in range(num_workers)]
+        self._spawner = None
+        self._spawner_conn = None
+        self._pids = {}
+        self._held = {}
+        self._pending = collections.deque()
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        parent_end, spawner_end = self._ctx.Pipe()
+        self._spawner = self._ctx.Process(target=_spawner_main, name='inference-spawner',
+                                          args=(spawner_end, self._ctx, self.core_sets,
+                                                [worker_end for _, worker_end in self._conns],
+                                                self.init_fn, self.handle_fn))
+        self._spawner.start()
+        self._spawner_conn = parent_end
+        for worker_id in range(self.num_workers):
+            self._spawner_conn.send(worker_id)
+        self._thread = threading.Thread(target=self._run, name='pool-dispatcher', daemon=True)
+        self._thread.start()
+
+    def _resolve(self, job_id, ok):
+        future = self._futures.pop(job_id, None)
+        if future is not None:
+            future.set_result(ok)
+
+    def _dispatch(self):
+        # Caller holds _lock. Hands pending jobs to live, idle workers
+        for worker_id in self._pids:
+            if not self._pending:
+                return
+            if worker_id not in self._held:
+                job_id, item = self._pending.popleft()
+                self._held[worker_id] = job_id
+                self._conns[worker_id][0].send((job_id, item))
+
+    def _on_result(self, worker_id):
+        job_id, ok = self._conns[worker_id][0].recv()
+        if self._held.get(worker_id) == job_id:
+            del self._held[worker_id]
+        self._resolve(job_id, ok)
+
+    def _on_event(self, kind, worker_id, pid, exitcode):
+        if kind == 'started':
+            self._pids[worker_id] = pid
+            return
+        # Results it sent before dying still count
+        parent_end, worker_end = self._conns[worker_id]
+        while parent_end.poll():
+            self._on_result(worker_id)
+        # A job it never read must not reach its replacement
+        while worker_end.poll():
+            worker_end.recv()
+        self._pids.pop(worker_id, None)
+        job_id = self._held.pop(worker_id, None)
+        if job_id is not None:
+            self._resolve(job_id, False)
+        if not self._stop.is_set():
+            print(f"[ERROR] Worker {worker_id} (pid {pid}) exited with {exitcode}, restarting")
+            self._spawner_conn.send(worker_id)
+
+    def _run(self):
+        while not self._stop.is_set():
+            conns = [self._spawner_conn] + [parent_end for parent_end, _ in self._conns]
+            for conn in wait(conns, timeout=0.5):
+                with self._lock:
+                    if conn is self._spawner_conn:
+                        try:
+                            self._on_event(*conn.recv())
+                        except EOFError:
+                            print("[ERROR] Worker spawner exited, workers are no longer replaced")
+                            self._stop.set()
+                            return
+                    else:
+                        self._on_result(next(i for i, (parent_end, _) in enumerate(self._conns)
+                                             if parent_end is conn))
+                    self._dispatch()
+
+    def pids(self):
+        with self._lock:
+            return list(self._pids.values())
+
+    def submit(self, item):
+        future = Future()
+        with self._lock:
+            job_id = next(self._ids)
+            self._futures[job_id] = future
+            self._pending.append((job_id, item))
+            self._dispatch()
+        return future
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for parent_end, _ in self._conns:
+            parent_end.send(_STOP)
+        if self._spawner is not None:
+            self._spawner_conn.send(_STOP)
+            self._spawner.join()
+        with self._lock:
+            for job_id in list(self._futures):
+                self._resolve(job_id, False)
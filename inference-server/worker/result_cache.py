@@ -0,0 +1,123 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import contextlib
+import threading
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(input_sha256, sex, target_diagnosis, starting_age, target_age,
+             sampler_name, num_steps, eta, seed, model_version=''):
+    # Everything that determines the generated volume. Covariates are rounded so that
+    # e.g. 0.7 and 0.7000000001 from the frontend's /100 normalisation share an entry
+    fields = {
+        'input': input_sha256,
+        'sex': int(sex),
+        'diagnosis': round(float(target_diagnosis), 6),
+        'starting_age': round(float(starting_age), 6),
+        'target_age': round(float(target_age), 6),
+        'sampler': sampler_name,
+        'num_steps': num_steps,
+        'eta': round(float(eta), 6),
+        'seed': seed,
+        'model': model_version,
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+# Generated volumes on local disk, one <key>.nii per entry, evicted least recently used first
+# once the directory exceeds max_bytes. The directory is the source of truth: a hit is a file that
+# exists, recency is its mtime and eviction measures the directory under an flock, so several
+# worker processes share the entries and the budget, and a restarted pod keeps its entries.
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock_path = os.path.join(cache_dir, '.lock')
+        with self._locked():
+            self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.nii')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Excludes the other threads of this process, then the other processes sharing the directory
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _scan(self):
+        # (mtime, size, path) of every entry currently in the directory
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.nii'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process in between
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key):
+        # Path of the cached volume, or None. Touching the file makes it the most recently used
+        # for every process, so an eviction running right after this removes it last
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, result_path):
+        path = self._path(key)
+        partial_path = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+        shutil.copyfile(result_path, partial_path)
+        with self._locked():
+            os.replace(partial_path, path)
+            self._evict()
+        return path
+
+    def _evict(self):
+        # Caller holds _locked()
+        entries = sorted(self._scan())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        entries = self._scan()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.,
+                    'entries': len(entries), 'bytes': sum(size for _, size, _ in entries)}
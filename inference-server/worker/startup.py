@@ -0,0 +1,54 @@
+import contextlib
+import os
+import time
+
+# Imported first by tools/inference.py, so this marks the start of the worker's own imports
+IMPORT_STARTED = time.perf_counter()
+
+
+def process_age():
+    # Seconds since the kernel started this process, i.e. including interpreter start-up (Linux only)
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the parenthesised command name, starttime is field 22 of the whole line
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except OSError:
+        return None
+    return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+
+# Wall time of each start-up phase of the worker: interpreter, imports, config, model load,
+# warmup, broker connection. report() prints the breakdown, export() publishes it as a gauge
+class StartupReport:
+    def __init__(self):
+        self.phases = []
+        age = process_age()
+        elapsed = time.perf_counter() - IMPORT_STARTED
+        if age is not None:
+            self.phases.append(('interpreter', max(0., age - elapsed)))
+        self.phases.append(('imports', elapsed))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self):
+        total = self.total() or 1.
+        lines = ['Startup:']
+        for name, seconds in self.phases:
+            lines.append(f'  {name:12s} {seconds:8.3f}s {100 * seconds / total:5.1f}%')
+        lines.append(f"  {'total':12s} {self.total():8.3f}s")
+        return '\n'.join(lines)
+
+    def export(self, gauge):
+        for name, seconds in self.phases:
+            gauge.set(seconds, phase=name)